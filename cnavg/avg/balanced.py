@@ -33,16 +33,27 @@
 """Definition of copy-number balancing across a sequence graph"""
  
 import sys
+import multiprocessing
 import graph as avg
-#import gabp.gabp as gabp
+import gabp.gabp as gabp
 import numpy as np
 import cnavg.basics.leastSquares as leastSquares
 
-TOL = 1e2
+try:
+	import scipy.sparse as sparse
+except ImportError:
+	sparse = None
+
+# Relative convergence tolerance of the iterative solver gabp.solve
+TOL = 1e-8
 FUDGE_FACTOR = 1
 SEG_FACTOR = FUDGE_FACTOR / 10
 EDGE_FACTOR = FUDGE_FACTOR * 10
 MIN_NOISE = 1e-3
+# Smallest problem whose components are solved across a process pool
+PARALLEL_SIZE = 5000
+# Weighted least squares solver, gabp.solve iterates instead of factorizing
+SOLVER = leastSquares.solve
 
 ##############################################
 ## Mapping of flow elements onto integer IDs 
@@ -50,89 +61,52 @@ MIN_NOISE = 1e-3
 
 class Mapping(object):
 	"""
-	An index of all the adjacencies and segments in a graph
+	An index of all the adjacencies and segments in a CompactGraph:
+	segments come first, owned by the lower node of each twin pair, then the bonds in CSR order
 	"""
-	def __init__(self):
-		self.segments = dict()
-		self.edges = dict()
-		self.size = 0
-
-	def addSegment(self, A):
-		self.segments[A] = self.size
-		self.size += 1
-
-	def getSegment(self, A, B):
-		return self.segments[min([A,B])]
-
-	def addEdge(self, A, B):
-		m = min([A, B])
-		M = max([A, B])
-		self.edges[(m,M)] = self.size
-		self.size += 1
-
-	def getEdge(self, A, B):
-		m = min([A, B])
-		M = max([A, B])
-		return self.edges[(m, M)]
-
-	def segmentStr(self, A):
-		return "\t".join([str(A), str(self.segments[A])])
-
-	def segmentsStr(self):
-		return "\n".join(map(lambda X: self.segmentStr(X), self.segments))
-
-	def edgeStr(self, pair):
-		return "\t".join([str(pair[0]), str(pair[1]), str(self.edges[(pair[0],pair[1])])])
-
-	def edgesStr(self):
-		return "\n".join(map(lambda X: self.edgeStr(X), self.edges))
+	def __init__(self, compact):
+		nodes = np.arange(len(compact))
+		owners = np.minimum(nodes, compact.twins)
+		self.segmentNodes = np.nonzero(owners == nodes)[0]
+		segmentIDs = np.zeros(len(compact), dtype=int)
+		segmentIDs[self.segmentNodes] = np.arange(len(self.segmentNodes))
+		# Column of the segment incident on each node
+		self.segments = segmentIDs[owners]
+
+		rows = compact.bondRows()
+		keys = np.minimum(rows, compact.indices) * len(compact) + np.maximum(rows, compact.indices)
+		uniques, self.edgeBonds, inverse = np.unique(keys, return_index=True, return_inverse=True)
+		# Column of each stored bond, shared by both of its directions
+		self.edges = inverse + len(self.segmentNodes)
+		self.size = len(self.segmentNodes) + len(uniques)
+
+	def segmentColumns(self):
+		return np.arange(len(self.segmentNodes))
+
+	def edgeColumns(self):
+		return np.arange(len(self.segmentNodes), self.size)
 
 	def __str__(self):
-		return "\n".join(sorted([self.edgesStr(), self.segmentsStr()]))
-
-def prepareEdgeMapping (mapping, tonode, fromnode):
-	if fromnode <= tonode:
-		mapping.addEdge(tonode, fromnode)
-	return mapping
-
-def prepareNodeMapping(mapping, node, graph):
-	if node <= graph[node].twin:
-		mapping.addSegment(node)
-	return reduce(lambda M, N: prepareEdgeMapping(M, N, node), graph[node].edges.keys(), mapping)
+		return "\n".join(["%i\t%i" % (X, Y) for X, Y in enumerate(self.segments)] + ["%i\t%i" % (X, Y) for X, Y in enumerate(self.edges)])
 
-def prepareGraphMapping(graph):
+def prepareGraphMapping(compact):
 	"""
 	Builds a mapping for the given sequence graph
 	"""
-	return reduce(lambda M,X: prepareNodeMapping(M,X, graph), graph.nodes(), Mapping())
+	return Mapping(compact)
 
 ##############################################
 ## Adding in estimates
 ##############################################
 
-def addSegmentEstimate(estimates, node, graph, mapping):
-	estimates[mapping.getSegment(node, graph[node].twin)] = float(sum(graph[node].segment))
-	return estimates
-
-def addEdgeEstimate(estimates, A, B, graph, mapping):
-	if graph[A].edges[B] >= 0:
-		estimates[mapping.getEdge(A, B)] = float(graph[A].edges[B])
-	else: 
-		estimates[mapping.getEdge(A, B)] = 0
-	return estimates
-
-def addNodeEdgesEstimates(estimates, node, graph, mapping):
-	return reduce(lambda E,N: addEdgeEstimate(E, node, N, graph, mapping), graph[node].edges.keys(), estimates)
-
-def initialNodeEstimates(estimates, node, graph, mapping):
-	estimates = addSegmentEstimate(estimates, node, graph, mapping)
-	return addNodeEdgesEstimates(estimates, node, graph, mapping)
-
-def initialEstimates(graph, mapping):
+def initialEstimates(compact, mapping):
 	"""
 	Prepares vector of observed values for the Gaussian propagation routine.
 	"""
-	return reduce(lambda E,N: initialNodeEstimates(E, N, graph, mapping), graph.nodes(), [0 for x in range(mapping.size)])
+	estimates = np.zeros(mapping.size)
+	estimates[mapping.segmentColumns()] = compact.segmentFlows()[mapping.segmentNodes]
+	estimates[mapping.edgeColumns()] = np.maximum(compact.flows[mapping.edgeBonds], 0)
+	return estimates
 
 ##############################################
 ## Adding in precisions
@@ -147,30 +121,16 @@ def variance(stddev):
 def precision(stddev):
 	return 1 / variance(stddev)
 
-def addSegmentPrecision(precisions, node, graph, mapping):
-	precisions[mapping.getSegment(node, graph[node].twin)] = precision(max(min(sum(graph[node].segment) / graph.segmentLength(node), SEG_FACTOR), MIN_NOISE))
-	return precisions
-
-def addEdgePrecision(precisions, A, B, graph, mapping):
-	if graph[A].edges[B] >= 0:
-		precisions[mapping.getEdge(A, B)] = precision(float(max([graph[A].edges[B], EDGE_FACTOR, MIN_NOISE])))
-	else:
-		precisions[mapping.getEdge(A, B)] = -1.0
-	assert type(precisions[mapping.getEdge(A, B)]) is float
-	return precisions
-
-def addNodeEdgesPrecisions(precisions, node, graph, mapping):
-	return reduce(lambda E,N: addEdgePrecision(E, node, N, graph, mapping), graph[node].edges.keys(), precisions)
-
-def initialNodePrecisions(precisions, node, graph, mapping):
-	precisions = addSegmentPrecision(precisions, node, graph, mapping)
-	return addNodeEdgesPrecisions(precisions, node, graph, mapping)
-
-def initialPrecisions(graph, mapping):
+def initialPrecisions(compact, mapping):
 	"""
 	Prepares vector of precisions (=1/variance) of the different observed values and constraints in the Gaussian factor graph.
 	"""
-	return reduce(lambda E,N: initialNodePrecisions(E, N, graph, mapping), graph.nodes(), [0 for x in range(mapping.size)])
+	precisions = np.zeros(mapping.size)
+	densities = compact.segmentFlows()[mapping.segmentNodes] / compact.segmentLengths()[mapping.segmentNodes]
+	precisions[mapping.segmentColumns()] = precision(np.maximum(np.minimum(densities, SEG_FACTOR), MIN_NOISE))
+	flows = compact.flows[mapping.edgeBonds]
+	precisions[mapping.edgeColumns()] = np.where(flows >= 0, precision(np.maximum(flows, max(EDGE_FACTOR, MIN_NOISE))), -1.0)
+	return precisions
 
 ##############################################
 ## Creating a matrix image of the graph
@@ -181,43 +141,105 @@ class LPProblem:
 	def __init__(self, columns):
 		self.columns = columns
 		self.matrix = None
+		self.rows = []
+		self.cols = []
+		self.coefficients = []
 		self.constraints = []
 		self.constraintPrecisions = []
 		self.estimatedValues = None
 		self.estimatePrecisions = None
 
-	def addConstraint(self, array, stddev):
-		if self.matrix is None:
-			self.matrix = np.vstack([array])
+	def addConstraints(self, count, rows, cols, coefficients, stddev):
+		"""Adds count rows to the constraint matrix, given as (row, column, coefficient) triplets over rows numbered from 0"""
+		self.rows.append(np.asarray(rows) + len(self.constraintPrecisions))
+		self.cols.append(cols)
+		self.coefficients.append(coefficients)
+		self.constraintPrecisions.extend([variance(stddev)] * count)
+
+	def buildMatrix(self):
+		"""Assembles the constraint matrix from the accumulated (row, column, coefficient) triplets"""
+		shape = (len(self.constraintPrecisions), self.columns)
+		self.rows, self.cols, self.coefficients = [np.concatenate(X) for X in (self.rows, self.cols, self.coefficients)]
+		if sparse is not None:
+			self.matrix = sparse.coo_matrix((self.coefficients, (self.rows, self.cols)), shape=shape).tocsr()
 		else:
-			self.matrix = np.append(self.matrix, np.vstack([array]), axis=0)
-
-	 	prior = - sum((array * self.estimatedValues))
-		self.constraints.append(prior)
-		self.constraintPrecisions.append(variance(stddev))
+			self.matrix = np.zeros(shape)
+			np.add.at(self.matrix, (self.rows, self.cols), self.coefficients)
+		self.constraints = list(- self.matrix.dot(np.array(self.estimatedValues, dtype=float)))
 
 	def __str__(self):
 		return "\n".join(map(str, [self.matrix, self.constraints, self.constraintPrecisions, self.estimatedValues, self.estimatePrecisions]))
 
-def edgeConstraint(array, node, tonode, mapping):
-	if node != tonode:
-		array[mapping.getEdge(node, tonode)] = 1
+def prepareGraphProblem(compact, mapping, problem):
+	"""Formulates a graph balancing problem into a Linear Programming problem, one constraint per node"""
+	nodes = np.arange(len(compact))
+	rows = compact.bondRows()
+	# A self loop enters its node twice
+	bondCoefficients = np.where(rows == compact.indices, 2, 1)
+	problem.addConstraints(len(nodes), np.concatenate([rows, nodes]), np.concatenate([mapping.edges, mapping.segments]), np.concatenate([bondCoefficients, -np.ones(len(nodes), dtype=int)]), FUDGE_FACTOR)
+	problem.buildMatrix()
+	return problem
+
+##############################################
+## Decomposition into independent problems
+##############################################
+
+def groupBy(labels, count):
+	"""Splits the indices of an array of labels into one ascending array per label"""
+	order = np.argsort(labels, kind='mergesort')
+	return np.split(order, np.cumsum(np.bincount(labels, minlength=count))[:-1])
+
+def componentIndices(compact, mapping):
+	"""Lists the rows and columns of the balancing problem of each connected component of the graph"""
+	labels = compact.components(twins=True)
+	count = labels.max() + 1 if len(labels) else 0
+	# Rows are the nodes, columns their segments then their bonds
+	rows = groupBy(labels, count)
+	segments = groupBy(labels[mapping.segmentNodes], count)
+	edges = groupBy(labels[compact.bondRows()[mapping.edgeBonds]], count)
+	return [(rows[X], np.concatenate([segments[X], edges[X] + len(mapping.segmentNodes)])) for X in range(count)]
+
+def componentProblem(x, problem, rows, columns):
+	return (np.asarray(x)[columns], problem.estimatePrecisions[columns], problem.matrix[rows, :][:, columns], np.asarray(problem.constraints)[rows], np.asarray(problem.constraintPrecisions)[rows])
+
+def solverOptions(start, columns=None):
+	"""Keyword arguments of SOLVER, only the iterative solver takes a tolerance and a warm start"""
+	if SOLVER is not gabp.solve:
+		return dict()
+	elif start is not None and columns is not None:
+		return dict(tolerance=TOL, start=np.asarray(start)[columns])
 	else:
-		array[mapping.getEdge(node, node)] = 2
-	return array
+		return dict(tolerance=TOL, start=start)
 
-def nodeConstraint(node, graph, mapping):
-	array = reduce(lambda A,E: edgeConstraint(A, node, E, mapping), graph[node].edges.keys(), np.zeros(mapping.size))
-	array[mapping.getSegment(node, graph[node].twin)] = -1
-	return array
+def _solveComponent(task):
+	arguments, options = task
+	return SOLVER(*arguments, **options)
 
-def prepareNodeProblem(problem, node, graph, mapping):
-	problem.addConstraint(nodeConstraint(node, graph, mapping), FUDGE_FACTOR)
-	return problem
+def solveProblem(compact, mapping, problem, processes=1, start=None):
+	"""
+	Solves the balancing problem independently on each connected component of the graph.
+	start, e.g. the corrections of an earlier solve of the same problem, warm starts an iterative SOLVER.
+	"""
+	x = np.zeros(mapping.size)
+	components = componentIndices(compact, mapping)
+	if len(components) == 1:
+		return SOLVER(x, problem.estimatePrecisions, problem.matrix, problem.constraints, problem.constraintPrecisions, **solverOptions(start))
+
+	tasks = [(componentProblem(x, problem, rows, columns), solverOptions(start, columns)) for rows, columns in components]
+	if processes > 1 and mapping.size >= PARALLEL_SIZE:
+		pool = multiprocessing.Pool(processes)
+		try:
+			results = pool.map(_solveComponent, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		results = map(_solveComponent, tasks)
 
-def prepareGraphProblem(graph, mapping, problem):
-	"""Formulates a graph balancing problem into a Linear Programming problem"""
-	return reduce(lambda P, N: prepareNodeProblem(P, N, graph, mapping), graph.nodes(), problem)
+	corrections = np.zeros(mapping.size)
+	for component, values in zip(components, results):
+		corrections[component[1]] = values
+	return corrections
 
 ##############################################
 ## Master function
@@ -225,19 +247,16 @@ def prepareGraphProblem(graph, mapping, problem):
 
 class BalancedAVG(avg.Graph):
 	"""A sequence graph characterised by balanced flow (i.e. the Laplacian of the conjugate flow is null)"""
-	def __init__(self, graph):
-		self.copy(graph)
-		mapping = prepareGraphMapping(graph)
+	def __init__(self, graph, processes=1):
+		compact = graph.compact()
+		mapping = prepareGraphMapping(compact)
 		problem = LPProblem(mapping.size)
-		problem.estimatedValues = initialEstimates(graph, mapping)
-		problem.estimatePrecisions = initialPrecisions(graph, mapping)
-		problem = prepareGraphProblem(graph, mapping, problem)
-
-		x = [0 for X in problem.estimatedValues]
-		corrections = leastSquares.solve(x, problem.estimatePrecisions, problem.matrix, problem.constraints, problem.constraintPrecisions)
-		# Relic of GaBP routine
-		#corrections, precisions = gabp.run(TOL, problem.matrix, problem.constraints, problem.constraintPrecisions, [0 for X in problem.estimatedValues], problem.estimatePrecisions)
-		self.updateGraph(corrections, mapping)
+		problem.estimatedValues = initialEstimates(compact, mapping)
+		problem.estimatePrecisions = initialPrecisions(compact, mapping)
+		problem = prepareGraphProblem(compact, mapping, problem)
+
+		corrections = solveProblem(compact, mapping, problem, processes)
+		self.updateGraph(compact, corrections, mapping)
 		self.correctIncongruities()
 		return
 
@@ -245,24 +264,19 @@ class BalancedAVG(avg.Graph):
 	## Creating a graph image of the flow solution
 	##############################################
 
-	def updateEdge(self, tonode, fromnode, values, mapping):
-		if self[fromnode].edges[tonode] >= 0:
-			self[fromnode].edges[tonode] += values[mapping.getEdge(tonode, fromnode)]
-		else:
-			self[fromnode].edges[tonode] = values[mapping.getEdge(tonode, fromnode)]
-
-	def updateNode(self, node, values, mapping):
-		oldSum = sum(self[node].segment)
-		if oldSum > 0:
-			for index in range(len(self[node].segment)):
-				self[node].segment[index] += values[mapping.getSegment(node, self[node].twin)] * self[node].segment[index] / oldSum
-		else:
-			self[node].segment[0] = values[mapping.getSegment(node, self[node].twin)]
-		map(lambda X: self.updateEdge(X, node, values, mapping), self[node].edges)
-		
-	def updateGraph(self, values, mapping):
-		"""Change the flow values to those produced by the LP method"""
-		map(lambda X: self.updateNode(X, values, mapping), self.nodes())
+	def updateGraph(self, compact, values, mapping):
+		"""Change the flow values to those produced by the LP method, and fill the graph from them"""
+		# Segment corrections are shared out in proportion to the existing flows
+		corrections = np.asarray(values)[mapping.segments]
+		sums = compact.segmentFlows()
+		positive = sums > 0
+		compact.segments[positive] += (corrections[positive] / sums[positive])[:, np.newaxis] * compact.segments[positive]
+		compact.segments[~positive, 0] = corrections[~positive]
+
+		# Bonds without estimate (negative flow) are replaced by their correction
+		corrections = np.asarray(values)[mapping.edges]
+		compact.flows = np.where(compact.flows >= 0, compact.flows + corrections, corrections)
+		compact.fillGraph(self)
 
 	##############################################
 	## Correction for overdemanded nodes
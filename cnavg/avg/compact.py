@@ -0,0 +1,185 @@
+# Copyright (c) 2012, Daniel Zerbino
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# (1) Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+# 
+# (2) Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in
+# the documentation and/or other materials provided with the
+# distribution.  
+# 
+# (3)The name of the author may not be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#!/usr/bin/env python
+
+"""
+Definition of CompactGraph, an array representation of a sequence graph
+"""
+
+import numpy as np
+
+from cnavg.avg.nodeFlow import NodeFlow
+from cnavg.basics.unionFind import UnionFind
+
+try:
+	import scipy.sparse as sparse
+	import scipy.sparse.csgraph as csgraph
+except ImportError:
+	sparse = None
+
+def sortOrder(nodes):
+	"""
+	Permutation which sorts a list of nodes, consistent with Node.__cmp__
+	"""
+	chrNames = sorted(set(X.chr for X in nodes))
+	chrIndices = dict((X, index) for index, X in enumerate(chrNames))
+	chrs = np.array([chrIndices[X.chr] for X in nodes], dtype=int)
+	positions = np.array([X.pos for X in nodes], dtype=np.int64)
+	IDs = np.array([X.ID for X in nodes], dtype=np.int64)
+	return np.lexsort((IDs, positions, chrs))
+
+def firstAppearanceLabels(labels):
+	"""
+	Renumbers component labels in order of first appearance
+	"""
+	uniques, firsts, inverse = np.unique(labels, return_index=True, return_inverse=True)
+	ranks = np.empty(len(uniques), dtype=int)
+	ranks[np.argsort(firsts)] = np.arange(len(uniques))
+	return ranks[inverse]
+
+class CompactGraph(object):
+	"""
+	Sequence graph stored as arrays: nodes are numbered in sorted order, 
+	bonds are stored in compressed sparse row (CSR) format
+	"""
+	def __init__(self, graph):
+		nodes = graph.nodes()
+		self.nodes = [nodes[X] for X in sortOrder(nodes)]
+		self.index = dict((X, index) for index, X in enumerate(self.nodes))
+		self.telomeres = np.array(sorted(self.index[X] for X in graph.telomeres if X in self.index), dtype=int)
+
+		# Node coordinates
+		self.chrNames = sorted(set(X.chr for X in self.nodes))
+		chrIndices = dict((X, index) for index, X in enumerate(self.chrNames))
+		self.chrs = np.array([chrIndices[X.chr] for X in self.nodes], dtype=int)
+		self.positions = np.array([X.pos for X in self.nodes], dtype=np.int64)
+		self.orientations = np.array([bool(X.orientation) for X in self.nodes], dtype=bool)
+		self.IDs = np.array([X.ID for X in self.nodes], dtype=np.int64)
+
+		# Segments and adjacencies, -1 when undefined
+		self.twins = np.array([self._nodeIndex(graph[X].twin) for X in self.nodes], dtype=int)
+		self.partners = np.array([self._nodeIndex(graph[X].partner) for X in self.nodes], dtype=int)
+		self.ploidies = np.array([len(graph[X].segment) for X in self.nodes], dtype=int)
+		self.segments = np.zeros((len(self.nodes), max([0] + list(self.ploidies))))
+		for index, node in enumerate(self.nodes):
+			self.segments[index, :self.ploidies[index]] = graph[node].segment
+
+		# Bonds
+		self.indptr = np.zeros(len(self.nodes) + 1, dtype=int)
+		indices = []
+		flows = []
+		for index, node in enumerate(self.nodes):
+			row = sorted((self.index[X], graph[node].edges[X]) for X in graph[node].edges)
+			indices.extend(X[0] for X in row)
+			flows.extend(X[1] for X in row)
+			self.indptr[index + 1] = len(indices)
+		self.indices = np.array(indices, dtype=int)
+		self.flows = np.array(flows, dtype=float)
+
+	def _nodeIndex(self, node):
+		if node is None:
+			return -1
+		else:
+			return self.index[node]
+
+	def __len__(self):
+		return len(self.nodes)
+
+	##########################################
+	## Accessors
+	##########################################
+	def bondRows(self):
+		""" Source node of each stored bond """
+		return np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+
+	def neighbours(self, index):
+		""" Nodes bonded to a node """
+		return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+	def bondFlows(self):
+		""" Sum of incident bond flows of each node """
+		return np.bincount(self.bondRows(), weights=self.flows, minlength=len(self.nodes))
+
+	def segmentFlows(self):
+		""" Sum of incident segment flows of each node """
+		return self.segments.sum(axis=1)
+
+	def segmentLengths(self):
+		""" Length of the incident segment of each node, as in NodeFlow.segmentLength """
+		return np.abs(self.positions - self.positions[self.twins]) + 1
+
+	def imbalances(self):
+		""" Difference between segment and bond flows at each node """
+		return np.abs(self.segmentFlows() - self.bondFlows())
+
+	##########################################
+	## Connectivity
+	##########################################
+	def components(self, twins=False, partners=False):
+		""" Component label of each node, through bonds and optionally segments and adjacencies, in order of first appearance """
+		sources = [self.bondRows()]
+		targets = [self.indices]
+		for links, use in ((self.twins, twins), (self.partners, partners)):
+			if use:
+				defined = np.nonzero(links >= 0)[0]
+				sources.append(defined)
+				targets.append(links[defined])
+		sources = np.concatenate(sources)
+		targets = np.concatenate(targets)
+
+		if sparse is not None:
+			matrix = sparse.coo_matrix((np.ones(len(sources)), (sources, targets)), shape=(len(self.nodes), len(self.nodes)))
+			labels = csgraph.connected_components(matrix, directed=True, connection='weak')[1]
+		else:
+			sets = UnionFind(len(self.nodes))
+			for source, target in zip(sources.tolist(), targets.tolist()):
+				sets.union(source, target)
+			labels = np.array([sets.find(X) for X in range(len(self.nodes))], dtype=int)
+		return firstAppearanceLabels(labels)
+
+	##########################################
+	## Conversion
+	##########################################
+	def fillGraph(self, graph):
+		""" Writes the nodes and flows into an empty Graph (or subclass) instance """
+		flows = self.flows.tolist()
+		for index, node in enumerate(self.nodes):
+			nodeFlow = NodeFlow(node)
+			if self.twins[index] >= 0:
+				nodeFlow.twin = self.nodes[self.twins[index]]
+			if self.partners[index] >= 0:
+				nodeFlow.partner = self.nodes[self.partners[index]]
+			nodeFlow.segment = self.segments[index, :self.ploidies[index]].tolist()
+			for position in range(self.indptr[index], self.indptr[index + 1]):
+				nodeFlow.edges[self.nodes[self.indices[position]]] = flows[position]
+			nodeFlow.selfLoops = node in nodeFlow.edges
+			graph[node] = nodeFlow
+		graph.telomeres = set(self.nodes[X] for X in self.telomeres)
+		return graph
@@ -27,201 +27,173 @@
 # HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
 # STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
 # IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
-# POSSIBILITY OF SUCH DAMAGE.
 #!/usr/bin/env python
 
 """
-Python wrapper for GaBP application in GraphLab
+Gaussian belief propagation (GaBP) solver for weighted least squares problems
 By Daniel Zerbino, based on Matlab code by Danny Bickson
 """
 
 import sys
-import os
-import tempfile
-import struct
 import numpy as np
-import subprocess
 
-#############################################
-# Convenience binary writer/reader functions:
-#############################################
-
-def writeDouble(F, x):
-     F.write(struct.pack('<d', x))
-
-def writeVector(F, vector):
-     for X in vector: 
-	writeDouble(F, X)
+try:
+	import scipy.sparse as sparse
+except ImportError:
+	sparse = None
 
-def writeInt(F, x):
-     F.write(struct.pack('<i', x))
+TOLERANCE = 1e-8
+"""Largest relative change of the marginal means between two rounds at convergence"""
 
-def readInt(F):
-     return struct.unpack('<i', F.read(struct.calcsize('i')))[0]
+MAX_ROUNDS = 10000
+"""Number of rounds of message passing after which the solver gives up"""
 
-def readDouble(F):
-     return struct.unpack('<d', F.read(struct.calcsize('d')))[0]
+DAMPING = 0.
+"""Fraction of the previous round's messages kept at each round"""
 
-def readVector(F, n):
-     return [readDouble(F) for i in range(n)]
+LOADING = 2.
+"""Diagonal dominance ratio enforced by diagonal loading, a margin above 1 speeds up message passing"""
 
 #############################################
-# Convenience MatLab like functions
+## Message passing on a square system
 #############################################
 
-def enumerate(M):
-     for i in range(np.shape(M)[0]):
-	for j in range(np.shape(M)[1]):
-	   # Beware of Matlab numbering!!
-	   yield i+1, j+1, M[i,j]
-
-def find(M):
-     return filter(lambda X: X[2] != 0, enumerate(M)) 
-
-
-def save_c_gl(fn, A, y, x=None, sigma_y=None, sigma_x=None, square=False):
-    """
-    Script for exporting system of linear equations of the type Ax = y to graphlab format.
-    Input: fn - output file name
-    A - A mxn matrix (if A is square than m=n)
-    y - mx1 observation vector
-    x - nx1 known solution (optional, if not given will write a vector of zeros)
-    sigma - a vector m+nx1 of noise levels (optional, for non-square matrices only)
-    """
-    m, n = np.shape(A)
-    if len(y) != m:
-       sys.exit('y vector should be of len as the number of A rows (%i and %i resp.)' % (len(y), m))
-
-    if x is not None and len(x) != n:
-       sys.exit('x vector length should be as the matrix A columns')
-
-    if sigma_y is None and sigma_x is not None:
-       sys.exit("sigma_y should be provided when entering sigma_x")
-
-    if sigma_x is None and sigma_y is not None:
-       sys.exit("sigma_x should be provided when entering sigma_y")
-
-    if sigma_x is not None:
-       if square:
-          sys.exit('sigma noise level input is allowed only for non-square matrices')
-       else:
-          if len(sigma_x) != n:
-             sys.exit('sigma_x length should be number of cols of A')
-          if len(sigma_y) != m:
-             sys.exit('sigma_y length should be number of rows of A')
-
-    if square:
-        # matrix is square, edges are non digonal entries
-        vals = find((A - np.diag(np.diag(A))))
-	print "Saving a square matrix A"
-    else:
-        # matrix is not square, edges are non zero values
-        vals = find(A)
-	print "Saving a non-square matrix A"
-
-    F = open(fn, 'wb')
-
-    #write matrix size
-    writeInt(F, m)
-    writeInt(F, n)
-
-   # write y (the observation), x (the solution, if known), diag(A) the
-   # variance (if known, else default variance of 1)
-    writeVector(F, y)
-    if x is not None:
-	writeVector(F, x)
-    else:
-	writeVector(F, (0 for x in range(n)))
-
-    if square:
-	writeVector(F, diag(A))
-    else:
-        if sigma_y is not None:
-	    writeVector(F, sigma_y)
-	    writeVector(F, sigma_x)
-        else:
-            writeVector(F, (1 for x in range(m+n)))
-
-    #write number of edges
-    assert len(vals) > 0
-    writeInt(F, len(vals))
-    # pad with zeros for 64 bit offset
-    writeInt(F, 0)
-
-    if not square:
-        offset = m
-    else:
-        offset = 0
-
-    #write all edges
-    for val in vals:
-       writeInt(F, val[0])
-       writeInt(F, val[1] + offset)
-       writeDouble(F, val[2])
-
-    F.close()
-
-    #verify written file header
-    F = open(fn,'rb')
-    x = readInt(F)
-    assert x == m
-    F.close()
-
-    print 'Wrote succesfully into file: %s' % fn
-
-
-def load_c_gl(filename, columns):
-    """
-    Script for reading the output of the GaBP GraphLab program into matlab
-    Returns (x, diag) tuple
-    where x = inv(A)*b as computed by GaBP
-    and diag = diag(inv(A)) - an approximation to the main diagonal of the inverse matrix of A.
-    """
-    F = open(filename, 'rb')
-
-    x = readVector(F, columns)
-    diag = readVector(F, columns)
-
-    F.close()
-    os.remove(filename)
-    return x, diag
+class Messages(object):
+	"""Precision and information (precision x mean) messages on the directed edges of a symmetric matrix"""
+	def __init__(self, A):
+		if sparse is not None and sparse.issparse(A):
+			A = sparse.coo_matrix(A)
+			rows, cols, values = A.row, A.col, A.data
+		else:
+			A = np.asarray(A)
+			rows, cols = np.nonzero(A)
+			values = A[rows, cols]
+		offDiagonal = rows != cols
+		self.diagonal = np.bincount(rows[~offDiagonal], weights=values[~offDiagonal], minlength=A.shape[0])
+		self.sources = rows[offDiagonal]
+		self.targets = cols[offDiagonal]
+		self.weights = values[offDiagonal]
+
+		# Index of the edge j -> i for each edge i -> j
+		order = np.lexsort((self.targets, self.sources))
+		reverseOrder = np.lexsort((self.sources, self.targets))
+		self.reverse = np.empty(len(order), dtype=int)
+		self.reverse[order] = reverseOrder
+
+		# Diagonal loading which makes the matrix diagonally dominant, hence GaBP convergent
+		offDiagonalSums = np.bincount(self.sources, weights=np.abs(self.weights), minlength=len(self.diagonal))
+		self.loading = np.maximum(LOADING * offDiagonalSums - self.diagonal, 0)
+		self.diagonal = self.diagonal + self.loading
+
+		self.precisions = np.zeros(len(self.sources))
+		self.informations = np.zeros(len(self.sources))
+
+	def marginals(self, b):
+		""" Precisions and information of each variable given all incoming messages """
+		size = len(self.diagonal)
+		precisions = self.diagonal + np.bincount(self.targets, weights=self.precisions, minlength=size)
+		informations = b + np.bincount(self.targets, weights=self.informations, minlength=size)
+		return precisions, informations
+
+	def update(self, b):
+		""" One synchronous round of message passing, returns the marginal means """
+		precisions, informations = self.marginals(b)
+		# Cavity distribution at the source, excluding the message from the target
+		cavityPrecisions = precisions[self.sources] - self.precisions[self.reverse]
+		cavityInformations = informations[self.sources] - self.informations[self.reverse]
+		newPrecisions = - self.weights * self.weights / cavityPrecisions
+		newInformations = - self.weights * cavityInformations / cavityPrecisions
+		self.precisions = DAMPING * self.precisions + (1 - DAMPING) * newPrecisions
+		self.informations = DAMPING * self.informations + (1 - DAMPING) * newInformations
+		return informations / precisions
+
+def propagate(messages, b, tolerance=TOLERANCE):
+	""" Passes messages until the marginal means of (A + loading).x = b converge """
+	means = messages.update(b)
+	for round in range(MAX_ROUNDS):
+		newMeans = messages.update(b)
+		if np.max(np.abs(newMeans - means)) <= tolerance * np.max(np.abs(newMeans)):
+			return newMeans
+		means = newMeans
+	sys.exit("GaBP did not converge after %i rounds" % MAX_ROUNDS)
+
+def solveSystem(A, b, messages=None, start=None, tolerance=TOLERANCE):
+	"""
+	Solves A.x = b for symmetric positive definite A.
+	The iterations start from start if given, e.g. the solution of a nearby system.
+	Returns x and the final messages, which can be passed back to warm start a system with the same matrix.
+	"""
+	if messages is None:
+		messages = Messages(A)
+	b = np.asarray(b, dtype=float)
+	if start is not None:
+		x = np.asarray(start, dtype=float)
+	else:
+		x = propagate(messages, b, tolerance)
+		if not np.any(messages.loading):
+			return x, messages
+
+	# GaBP on the loaded matrix is used as preconditioner of a conjugate gradient on A,
+	# each preconditioning step being warm started from the messages of the previous one
+	residual = b - A.dot(x)
+	scale = max(np.max(np.abs(b)), 1)
+	if np.max(np.abs(residual)) < tolerance * scale:
+		return x, messages
+	preconditioned = propagate(messages, residual, tolerance)
+	direction = preconditioned
+	product = np.dot(residual, preconditioned)
+	for round in range(MAX_ROUNDS):
+		if np.max(np.abs(residual)) < tolerance * scale:
+			return x, messages
+		image = A.dot(direction)
+		step = product / np.dot(direction, image)
+		x = x + step * direction
+		residual = residual - step * image
+		newPreconditioned = propagate(messages, residual, tolerance)
+		# Polak-Ribiere update, robust to the slight variations of the preconditioner
+		newProduct = np.dot(residual, newPreconditioned)
+		direction = newPreconditioned + (max(newProduct - np.dot(residual, preconditioned), 0) / product) * direction
+		preconditioned = newPreconditioned
+		product = newProduct
+	sys.exit("GaBP did not converge after %i outer rounds" % MAX_ROUNDS)
 
 ########################################################
-## Wrapper Utility to be used from outside
+## Weighted least squares interface
 ########################################################
 
-def runGaBP(convergence, A, y, sigma_y=None, x=None, sigma_x=None, square=False):
-    """Wrapper function for the GaBP module which resolves a Gaussian propagation problem using GraphLab"""
-    file, input = tempfile.mkstemp(dir='.')
-
-    save_c_gl(input, A, y, x=x, sigma_y=sigma_y, sigma_x=sigma_x, square=square)
-
-    args = ['gabp', '--data', input, '--threshold', str(convergence), '--algorithm', '0', '--scheduler=round_robin', '--square']
-    if not square:
-        args.append('false')
-    else:
-	args.append('true')
-    print "Running " + " ".join(args)
-    ret = subprocess.Popen(args, stdout=sys.stdout, stderr=subprocess.STDOUT).wait()
-
-    if ret != 0:
-	sys.exit("GaBP did not complete")
-
-    os.remove(input)
-    x2, diag = load_c_gl(input + ".out", len(x))
-    return x2, diag
+def normalEquations(x, precision_x, matrix, y, precision_y):
+	"""M^T.diag(W).M and M^T.W.Y, as in cnavg.basics.leastSquares"""
+	# Negative precisions apply to the null equation 0 = 0
+	W_x = np.array(precision_x, dtype=float)
+	W_x[W_x < 0] = 0
+	W_y = np.asarray(precision_y, dtype=float)
+	if sparse is not None:
+		M = sparse.csr_matrix(matrix)
+		MTWM = sparse.diags(W_x) + M.T.dot(sparse.diags(W_y)).dot(M)
+	else:
+		M = np.asarray(matrix)
+		MTWM = np.diag(W_x) + np.dot(M.T * W_y, M)
+	MTWY = W_x * np.asarray(x, dtype=float) + M.T.dot(W_y * np.asarray(y, dtype=float))
+	return MTWM, MTWY
+
+def solve(x, precision_x, matrix, y, precision_y, start=None, tolerance=TOLERANCE):
+	"""
+	Drop-in replacement for cnavg.basics.leastSquares.solve using GaBP.
+	start, e.g. the solution of an earlier solve of the same problem, warm starts the iterations.
+	"""
+	A, b = normalEquations(x, precision_x, matrix, y, precision_y)
+	return solveSystem(A, b, start=start, tolerance=tolerance)[0]
 
 #########################################################
 ## Unit test
 #########################################################
 def main():
 	A = np.array([[0.2785, 0.9649],[0.5469, 0.1576],[0.9575, 0.9706]])
-        y = np.array([1.2434, 0.7045, 1.9281])
-	sigma_y= np.array([1e-10, 1e-10, 1e-10]) 
-        x = np.array([0, 0])
-	sigma_x = np.array([1, 1])
-        convergence = 1e-10
-        x2, diag = runGaBP(convergence, A, y, sigma_y=sigma_y, x=x, sigma_x=sigma_x)
+	y = np.array([1.2434, 0.7045, 1.9281])
+	precision_y = np.array([1e2, 1e2, 1e2])
+	x = np.array([0, 0])
+	precision_x = np.array([1, 1])
+	x2 = solve(x, precision_x, A, y, precision_y)
 
 	print 'A'
 	print A
@@ -235,8 +207,6 @@ def main():
 	print x2
 	print 'Final Error'
 	print A.dot(x2) - y
-	print 'diag'	
-	print diag
 
 if __name__=='__main__':
-        main()
+	main()
@@ -38,6 +38,7 @@ import random
 
 from cnavg.avg.node import Node
 from cnavg.avg.nodeFlow import NodeFlow
+from cnavg.avg.compact import CompactGraph, sortOrder
 
 try:
     import cPickle 
@@ -58,6 +59,15 @@ class Graph(dict):
 		"""Returns list of nodes"""
 		return self.keys()
 
+	def sortedNodes(self):
+		"""Returns sorted list of nodes"""
+		nodes = self.nodes()
+		return [nodes[X] for X in sortOrder(nodes)]
+
+	def compact(self):
+		"""Returns an array representation of the graph"""
+		return CompactGraph(self)
+
 	def createNode(self, chr, pos, orientation, name=None):
 		"""Creates a node and adds it to the graph"""
 		node = Node(len(self), chr, pos, orientation, name)
@@ -178,7 +188,7 @@ class Graph(dict):
 		return all(map(lambda X: self.validateNode(X), self))
 
 	def coverageStats(self):
-		return "\n".join(map(NodeFlow.coverageStats, filter(lambda X: X.node < X.twin, sorted(self.values()))))
+		return "\n".join(map(NodeFlow.coverageStats, filter(lambda X: X.node < X.twin, (self[X] for X in self.sortedNodes()))))
 
 	def __str__(self):
 		"""
@@ -225,13 +235,13 @@ class Graph(dict):
 		return self[node].segmentLength()
 
 	def printCNVs(self):
-		return "\n".join(filter(lambda X: X is not None, (self[X].printCNVs(self) for X in sorted(self))))
+		return "\n".join(filter(lambda X: X is not None, (self[X].printCNVs(self) for X in self.sortedNodes())))
 
 	def printMajority(self):
-		return "\n".join(filter(lambda X: X is not None, (self[X].printMajority(self) for X in sorted(self))))
+		return "\n".join(filter(lambda X: X is not None, (self[X].printMajority(self) for X in self.sortedNodes())))
 
 	def printMinority(self):
-		return "\n".join(filter(lambda X: X is not None, (self[X].printMinority(self) for X in sorted(self))))
+		return "\n".join(filter(lambda X: X is not None, (self[X].printMinority(self) for X in self.sortedNodes())))
 
 def testGraph():
 	graph = Graph()
@@ -39,6 +39,7 @@ import cnavg.cactus.graph as cactus
 import cnavg.cactus.oriented as oriented
 import cnavg.cactusSampling.sampling as normalized
 import cnavg.cactus.balanced as balanced
+from cnavg.basics.indexedHeap import IndexedHeap
 import copy
 
 
@@ -46,6 +47,9 @@ class Module(avg.Graph):
         """Sequence graph associated to a Cactus net"""
         def __init__(self, net=None, graph=None, cnvs=None):
                 super(Module, self).__init__()
+                self.owned = set()
+                self.edgeTable = None
+                self.edgeHeap = None
 
                 if net is None:
                         return
@@ -66,7 +70,7 @@ class Module(avg.Graph):
 
                 if not all(self[X].twin is not None for X in self.nodes()):
                         print self
-                        print "\n".join(map(str,filter(lambda X: self[X].twin is None, sorted(self.nodes()))))
+                        print "\n".join(map(str,filter(lambda X: self[X].twin is None, self.sortedNodes())))
                         assert False
 
                 self.stub = StubNode(len(graph))
@@ -83,8 +87,11 @@ class Module(avg.Graph):
                 assert self.balanced()
 
         def copy(self, other):
-                """ Copy data onto other instance """
-                super(Module, self).copy(other)
+                """ Copy data onto other instance, sharing the NodeFlows until either module modifies them """
+                self.update(other)
+                self.telomeres = copy.copy(other.telomeres)
+                self.owned = set()
+                other.owned = set()
                 self.pseudotelomeres = copy.copy(other.pseudotelomeres)
                 self.stub = other.stub
 		self.net = other.net
@@ -108,6 +115,11 @@ class Module(avg.Graph):
         def __hash__(self):
                 return id(self)
 
+        def __setstate__(self, state):
+                self.__dict__.update(state)
+                if 'owned' not in state:
+                        self.owned = set()
+
         def removeEdgeFlow(self, edge):
                 # Conversion from conjugate flow to flow
 # DEBUG
@@ -115,6 +127,8 @@ class Module(avg.Graph):
                         self.changeLiftedEdge(edge.start, edge.finish, edge.value)
                 else:
                         self.changeSegment(edge.start, edge.index, -edge.value)
+                if self.edgeTable is not None:
+                        self._updateEdgeIndex(edge.start, edge.finish, edge.index)
 
         def addEdgeFlow(self, edge):
                 # Conversion from conjugate flow to flow
@@ -122,6 +136,8 @@ class Module(avg.Graph):
                         self.changeLiftedEdge(edge.start, edge.finish, -edge.value)
                 else:
                         self.changeSegment(edge.start, edge.index, edge.value)
+                if self.edgeTable is not None:
+                        self._updateEdgeIndex(edge.start, edge.finish, edge.index)
 
         def addCycleFlow(self, cycle):
 		map(self.addEdgeFlow, cycle)
@@ -132,7 +148,7 @@ class Module(avg.Graph):
         def addNetEnd(self, node, graph):
                 self.addNode(node)
 
-                if graph[node].partner in self.nodes():
+                if graph[node].partner in self:
                         self.createAdjacency(node, graph[node].partner)
                 for dest in graph[node].edges:
                         if dest in self:
@@ -140,7 +156,7 @@ class Module(avg.Graph):
 
         def close(self, graph, cnvs):
                 """ Connect pseudotelomeres as virtual twins """
-                nodes = filter(lambda X: X.orientation == True, sorted(self.nodes()))
+                nodes = filter(lambda X: X.orientation == True, self.sortedNodes())
                 if len(nodes) < 1:
                         return
                 else:
@@ -187,21 +203,126 @@ class Module(avg.Graph):
                 assert all(self.nodeBalanced(X) for X in self.nodes())
                 return True
 
+	####################################################
+	## Copy-on-write node flows
+	####################################################
+	def own(self, node):
+		""" Ensures that the NodeFlow of a node is not shared with another module before it is modified """
+		if node not in self.owned:
+			self[node] = copy.copy(self[node])
+			self.owned.add(node)
+		return self[node]
+
+	def addNode(self, node):
+		if node not in self:
+			super(Module, self).addNode(node)
+			self.owned.add(node)
+
+	def addLiftedEdge(self, A, B, value):
+		self.addNode(A)
+		self.addNode(B)
+		self.own(A)
+		self.own(B)
+		return super(Module, self).addLiftedEdge(A, B, value)
+
+	def setLiftedEdge(self, A, B, value):
+		self.addNode(A)
+		self.addNode(B)
+		self.own(A)
+		self.own(B)
+		return super(Module, self).setLiftedEdge(A, B, value)
+
+	def changeLiftedEdge(self, A, B, value):
+		self.own(A)
+		self.own(B)
+		return super(Module, self).changeLiftedEdge(A, B, value)
+
+	def changeSegment(self, node, index, increment):
+		self.own(node)
+		self.own(self[node].twin)
+		super(Module, self).changeSegment(node, index, increment)
+
+	def createSegment(self, A, B, values):
+		self.addNode(A)
+		self.addNode(B)
+		self.own(A)
+		self.own(B)
+		super(Module, self).createSegment(A, B, values)
+
+	def createAdjacency(self, A, B):
+		self.addNode(A)
+		self.addNode(B)
+		self.own(A)
+		self.own(B)
+		super(Module, self).createAdjacency(A, B)
+
 	####################################################
 	## Resetting values
 	####################################################
 	def resetBonds(self, node):
-		self[node].edges = dict((X, 0) for X in self[node].edges)
+		self.own(node).edges = dict((X, 0) for X in self[node].edges)
 
 	def resetSegments(self, node):
-		self[node].segment = [0 for X in self[node].segment]
+		self.own(node).segment = [0 for X in self[node].segment]
 
 	def resetNode(self, node):
-		self.resetSegments(node)
-		self.resetBonds(node)
+		""" Replaces the NodeFlow of a node with a null copy, without duplicating its flows first """
+		self[node] = self[node].nullCopy()
+		self.owned.add(node)
 
 	def reset(self):
 		map(self.resetNode, self.nodes())
+
+	####################################################
+	## Incremental edge index
+	####################################################
+	def _edgeValue(self, node, dest, index):
+		# Conjugate flow!
+		if index == -1:
+			return -self[node].edges[dest]
+		else:
+			return self[node].segment[index]
+
+	def _edgeKey(self, A, B, index):
+		if id(A) <= id(B):
+			return (A, B, index)
+		else:
+			return (B, A, index)
+
+	def _updateEdgeIndex(self, A, B, index):
+		value = self._edgeValue(A, B, index)
+		self.edgeTable[A][(B, index)] = value
+		self.edgeTable[B][(A, index)] = value
+		if A is B:
+			return
+		key = self._edgeKey(A, B, index)
+		if abs(value) > self.edgeThreshold:
+			self.edgeHeap.update(key, abs(value))
+		else:
+			self.edgeHeap.discard(key)
+
+	def indexEdges(self, threshold):
+		""" Builds the table of signed adjacencies and the heap of edges with |flow| above threshold, both kept up to date by addEdgeFlow and removeEdgeFlow """
+		self.edgeThreshold = threshold
+		self.edgeTable = dict((X, dict()) for X in self)
+		self.edgeHeap = IndexedHeap()
+		for node in self:
+			for dest in self[node].edges:
+				self._updateEdgeIndex(node, dest, -1)
+			for index in range(len(self[node].segment)):
+				self._updateEdgeIndex(node, self[node].twin, index)
+
+	def minimumEdge(self):
+		""" Returns the indexed edge with the smallest |flow| as a (start, finish, value, index) tuple, None if none left """
+		key = self.edgeHeap.peek()
+		if key is None:
+			return None
+		else:
+			return (key[0], key[1], self.edgeTable[key[0]][(key[1], key[2])], key[2])
+
+	def signedEdges(self, node):
+		""" Returns the indexed edges incident on a node as (start, finish, value, index) tuples """
+		return [(node, X[0], self.edgeTable[node][X], X[1]) for X in self.edgeTable[node]]
 	
 
 def netModulePairs(graph):
@@ -49,6 +49,7 @@ class Node(coords.OrientedPosition):
 	"""
 	Node in a sequence graph, i.e. the end of a segment edge, a breakend.
 	"""
+	__slots__ = ('ID', 'name', 'sortKey')
 
 	def __init__(self, ID, chr, pos, orientation, name):
 		super(Node, self).__init__(chr, pos, orientation)
@@ -57,6 +58,11 @@ class Node(coords.OrientedPosition):
 			self.name = str(self.ID)
 		else:
 			self.name = str(name)
+		self.sortKey = (self.chr, self.pos, self.ID)
+
+	def __setstate__(self, state):
+		super(Node, self).__setstate__(state)
+		self.sortKey = (self.chr, self.pos, self.ID)
 
 	def __cmp__(self, other):
 		"""
@@ -64,12 +70,7 @@ class Node(coords.OrientedPosition):
 		"""
 		assert self is not None
 		assert other is not None
-		if cmp(self.chr, other.chr):
-			return cmp(self.chr, other.chr)
-		elif cmp(self.pos, other.pos):
-			return cmp(self.pos, other.pos)
-		else:
-			return cmp(self.ID, other.ID)
+		return cmp(self.sortKey, other.sortKey)
 
 	# Had to redefine hash because the comparison function is not a strict ordering function.
 	def __hash__(self):
@@ -104,5 +105,7 @@ class StubNode(Node):
 	"""
 	A node which represents an unidentified position in the genome
 	"""
+	__slots__ = ()
+
 	def __init__(self, ID):
 		super(StubNode, self).__init__(ID, "None", 0, True, "Stub")
@@ -39,11 +39,14 @@ import copy
 import random
 
 from cnavg.avg.node import Node
+from cnavg.basics.slotted import Slotted
 
-class NodeFlow(object):
+class NodeFlow(Slotted):
 	"""
 	Flow data of the edges incident on a given node
 	"""
+	__slots__ = ('node', 'edges', 'twin', 'segment', 'partner', 'selfLoops')
+
 	def __init__(self, node):
 		self.node = node
 		self.edges = dict()
@@ -57,14 +60,25 @@ class NodeFlow(object):
 		new.twin = self.twin
 		new.segment = copy.copy(self.segment)
 		new.partner = self.partner
-		for dest in self.edges:
-			new.edges[dest] = self.edges[dest]
+		new.edges = dict(self.edges)
 		if hasattr(self, 'selfLoops'):
 			new.selfLoops = self.selfLoops
 		else:
 			new.selfLoops = (self.node in self.edges)
 		return new
 
+	def nullCopy(self):
+		"""
+		Returns a copy with the same topology but null flows.
+		"""
+		new = NodeFlow(self.node)
+		new.twin = self.twin
+		new.segment = [0 for X in self.segment]
+		new.partner = self.partner
+		new.edges = dict.fromkeys(self.edges, 0)
+		new.selfLoops = self.selfLoops
+		return new
+
 	def __cmp__(self, other):
 		"""
 		Ordering by node position.
@@ -34,10 +34,14 @@
 Definition of geometric objects along chromosomes.
 """
 
-class Region(object):
+from cnavg.basics.slotted import Slotted
+
+class Region(Slotted):
        """ 
        A contiguous region.
        """
+       __slots__ = ('chr', 'start', 'finish')
+
        def __init__(self, chr, start, finish):
               self.chr = str(chr)
               self.start = int(start)
@@ -70,6 +74,8 @@ class Region(object):
 
 class Position(Region):
        """ A 1-bp region """
+       __slots__ = ('pos',)
+
        def __init__(self, chr, pos):
               super(Position, self).__init__(chr, pos, pos)
               self.pos = int(pos)
@@ -86,6 +92,8 @@ def orientationChar(orientation):
 
 class OrientedRegion(Region):
        """ A region with an assigned strand """
+       __slots__ = ('orientation',)
+
        def __init__(self, chr, start, finish, orientation):
               super(OrientedRegion, self).__init__(chr, start, finish)
               self.orientation = bool(orientation)
@@ -113,6 +121,8 @@ class OrientedRegion(Region):
 
 class OrientedPosition(OrientedRegion):
        """ A position with an assigned strand """
+       __slots__ = ('pos',)
+
        def __init__(self, chr, pos, orientation):
               super(OrientedPosition, self).__init__(chr, pos, pos, orientation)
               self.pos = int(pos)
@@ -0,0 +1,120 @@
+# Copyright (c) 2012, Daniel Zerbino
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# (1) Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+# 
+# (2) Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in
+# the documentation and/or other materials provided with the
+# distribution.  
+# 
+# (3)The name of the author may not be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#!/usr/bin/env python
+
+"""Definition of an indexed binary min-heap"""
+
+class IndexedHeap(object):
+	"""Binary min-heap of keys, whose priorities can be updated or removed in place"""
+
+	###################################
+	## Basics
+	###################################
+	def __init__(self):
+		self.heap = list()
+		self.priority = dict()
+		self.position = dict()
+
+	def __len__(self):
+		return len(self.heap)
+
+	def __contains__(self, key):
+		return key in self.position
+
+	###################################
+	## Internal
+	###################################
+	def _swap(self, i, j):
+		self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+		self.position[self.heap[i]] = i
+		self.position[self.heap[j]] = j
+
+	def _siftUp(self, i):
+		while i > 0:
+			parent = (i - 1) / 2
+			if self.priority[self.heap[i]] < self.priority[self.heap[parent]]:
+				self._swap(i, parent)
+				i = parent
+			else:
+				return
+
+	def _siftDown(self, i):
+		size = len(self.heap)
+		while True:
+			smallest = i
+			for child in (2 * i + 1, 2 * i + 2):
+				if child < size and self.priority[self.heap[child]] < self.priority[self.heap[smallest]]:
+					smallest = child
+			if smallest == i:
+				return
+			self._swap(i, smallest)
+			i = smallest
+
+	###################################
+	## Operations
+	###################################
+	def update(self, key, priority):
+		"""Inserts key or changes its priority"""
+		if key in self.position:
+			old = self.priority[key]
+			self.priority[key] = priority
+			if priority < old:
+				self._siftUp(self.position[key])
+			else:
+				self._siftDown(self.position[key])
+		else:
+			self.priority[key] = priority
+			self.position[key] = len(self.heap)
+			self.heap.append(key)
+			self._siftUp(len(self.heap) - 1)
+
+	def discard(self, key):
+		"""Removes key if present"""
+		if key not in self.position:
+			return
+		i = self.position[key]
+		last = len(self.heap) - 1
+		if i != last:
+			self._swap(i, last)
+		self.heap.pop()
+		del self.position[key]
+		del self.priority[key]
+		if i < len(self.heap):
+			moved = self.heap[i]
+			self._siftUp(i)
+			self._siftDown(self.position[moved])
+
+	def peek(self):
+		"""Returns key with lowest priority (None if empty)"""
+		if len(self.heap) == 0:
+			return None
+		else:
+			return self.heap[0]
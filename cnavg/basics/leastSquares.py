@@ -34,7 +34,38 @@
  
 import numpy as np
 
+try:
+	import scipy.sparse as sparse
+	import scipy.sparse.linalg as sparseLinalg
+except ImportError:
+	sparse = None
+
+DENSE_SIZE = 100
+"""Problems with fewer unknowns than this are solved with dense matrices"""
+
 def solve(x, precision_x, matrix, y, precision_y):
+	"""Weighted least squares resolution, sparse for large problems when SciPy is available"""
+	if sparse is None or len(x) < DENSE_SIZE:
+		if sparse is not None and sparse.issparse(matrix):
+			matrix = matrix.toarray()
+		return solveDense(x, precision_x, matrix, y, precision_y)
+	else:
+		return solveSparse(x, precision_x, matrix, y, precision_y)
+
+def solveSparse(x, precision_x, matrix, y, precision_y):
+	"""Same as solveDense, but the normal equations are assembled and factorized as sparse matrices"""
+	# Negative precisions apply to the null equation 0 = 0, see solveDense
+	W_x = np.array(precision_x, dtype=float)
+	W_x[W_x < 0] = 0
+	W_y = np.asarray(precision_y, dtype=float)
+	M = sparse.csr_matrix(matrix)
+
+	# M^T.diag(W).M = diag(W_x) + C^T.diag(W_y).C, and likewise for M^T.W.Y
+	MTWM = sparse.diags(W_x) + M.T.dot(sparse.diags(W_y)).dot(M)
+	MTWY = W_x * np.asarray(x, dtype=float) + M.T.dot(W_y * np.asarray(y, dtype=float))
+	return sparseLinalg.spsolve(MTWM.tocsc(), MTWY)
+
+def solveDense(x, precision_x, matrix, y, precision_y):
 	"""Direct resolution of the problem using weighted least squares algorithm"""
 	"""See http://en.wikipedia.org/wiki/Least_squares#Weighted_least_squares"""
 	# Likelihoods: X = x +/- sigma_x = 0 +/- sigma_x
@@ -0,0 +1,51 @@
+# Copyright (c) 2012, Daniel Zerbino
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# (1) Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+# 
+# (2) Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in
+# the documentation and/or other materials provided with the
+# distribution.  
+# 
+# (3)The name of the author may not be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#!/usr/bin/env python
+
+"""Base class for objects with __slots__ which can be pickled and copied"""
+
+class Slotted(object):
+	"""Object whose attributes are declared in __slots__, pickled as a dictionary of attributes"""
+	__slots__ = ()
+
+	def __getstate__(self):
+		state = dict()
+		for cls in type(self).__mro__:
+			for name in cls.__dict__.get('__slots__', ()):
+				if hasattr(self, name):
+					state[name] = getattr(self, name)
+		if hasattr(self, '__dict__'):
+			state.update(self.__dict__)
+		return state
+
+	def __setstate__(self, state):
+		# Also restores objects pickled before their class was slotted
+		for name in state:
+			setattr(self, name, state[name])
@@ -0,0 +1,91 @@
+# Copyright (c) 2012, Daniel Zerbino
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# (1) Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+# 
+# (2) Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in
+# the documentation and/or other materials provided with the
+# distribution.  
+# 
+# (3)The name of the author may not be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+#!/usr/bin/env python
+
+"""Definition of a disjoint set forest over integer indices"""
+
+class UnionFind(object):
+	"""Disjoint set forest over the integers 0..size-1, with path halving and union by size"""
+
+	###################################
+	## Basics
+	###################################
+	def __init__(self, size):
+		self.parent = range(size)
+		self.size = [1] * size
+
+	def __len__(self):
+		return len(self.parent)
+
+	###################################
+	## Operations
+	###################################
+	def find(self, index):
+		"""Returns the representative of index's set"""
+		parent = self.parent
+		while parent[index] != index:
+			parent[index] = parent[parent[index]]
+			index = parent[index]
+		return index
+
+	def union(self, indexA, indexB):
+		"""Merges the sets of indexA and indexB, returns the new representative"""
+		rootA = self.find(indexA)
+		rootB = self.find(indexB)
+		if rootA == rootB:
+			return rootA
+		if self.size[rootA] < self.size[rootB]:
+			rootA, rootB = rootB, rootA
+		self.parent[rootB] = rootA
+		self.size[rootA] += self.size[rootB]
+		return rootA
+
+	def components(self):
+		"""Returns the sets as lists of indices, ordered by smallest member"""
+		roots = dict()
+		components = []
+		for index in range(len(self.parent)):
+			root = self.find(index)
+			if root not in roots:
+				roots[root] = len(components)
+				components.append([])
+			components[roots[root]].append(index)
+		return components
+
+	def labels(self):
+		"""Returns for each index the rank of its set in components()"""
+		roots = dict()
+		labels = []
+		for index in range(len(self.parent)):
+			root = self.find(index)
+			if root not in roots:
+				roots[root] = len(roots)
+			labels.append(roots[root])
+		return labels
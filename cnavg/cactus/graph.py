@@ -40,6 +40,7 @@ from cnavg.cactus.group import Group
 from cnavg.cactus.block import Block
 from cnavg.cactus.chain import Chain
 from cnavg.cactus.net import Net
+from cnavg.basics.unionFind import UnionFind
 
 		
 def _updateMapping(mapping, pair):
@@ -54,20 +55,61 @@ def _updateMapping(mapping, pair):
 		mapping[B].append((A, block))
 	return mapping
 
+def _representatives(labels):
+	representatives = dict()
+	for index, label in enumerate(labels):
+		if label not in representatives:
+			representatives[label] = index
+	return [representatives[X] for X in range(len(representatives))]
+
+def _netAdjacency(labels, blocks):
+	adjacency = [[] for X in range(max(labels) + 1)]
+	for index, pair in enumerate(blocks):
+		netA, netB = labels[pair[0]], labels[pair[1]]
+		adjacency[netA].append((netB, index))
+		if netB != netA:
+			adjacency[netB].append((netA, index))
+	return adjacency
+
+def _chainCycles(adjacency):
+	""" Returns the cycles of a cactus graph given as adjacency lists of (neighbour, edge) pairs """
+	dfn = [None] * len(adjacency)
+	father = [None] * len(adjacency)
+	fatherEdge = [None] * len(adjacency)
+	cycles = []
+
+	# Arbitrary depth first numbering
+	for start in range(len(adjacency)):
+		if dfn[start] is not None:
+			continue
+		stack = [(start, None, None, 0)]
+		while len(stack) > 0:
+			vertex, parent, edge, depth = stack.pop()
+			if dfn[vertex] is None:
+				dfn[vertex] = depth
+				father[vertex] = parent
+				fatherEdge[vertex] = edge
+				stack.extend((X[0], vertex, X[1], depth + 1) for X in adjacency[vertex])
+
+	# Look for loop closures
+	for vertex in range(len(adjacency)):
+		for vertex2, edge in adjacency[vertex]:
+			if edge != fatherEdge[vertex] and dfn[vertex2] <= dfn[vertex]:
+				# Aha: loop closure: follow fathers to self:
+				cycle = [edge]
+				vertex3 = vertex
+				while vertex3 != vertex2:
+					cycle.append(fatherEdge[vertex3])
+					vertex3 = father[vertex3]
+				cycles.append(cycle)
+
+	return cycles
+
 def _finalDest(prev, curr, bridges):
 	assert len(bridges[curr]) > 0
-	if len(bridges[curr]) != 2:
-		return curr
-	else:
-		next = filter(lambda X: X[0] != prev, bridges[curr])[0][0]
-		return _finalDest(curr, next, bridges)
-
-def _collapseBridge(nets, net, bridges):
-	if len(bridges[net]) == 0 or len(bridges[net]) == 2:
-		return nets
-	else:
-		mergedNets = [net] + map(lambda X: _finalDest(net, X[0], bridges), bridges[net])
-		return filter(lambda X: X not in mergedNets, nets) + [sum(mergedNets, Net([]))]
+	while len(bridges[curr]) == 2:
+		prev, curr = curr, filter(lambda X: X[0] != prev, bridges[curr])[0][0]
+	return curr
 
 class Cactus(avg.Graph):
 	"""A Cactus graph"""
@@ -81,21 +123,27 @@ class Cactus(avg.Graph):
 		# Compute basic components
 		groups = self.computeGroups()
 		self.nodeGroup = dict((N,G) for G in groups for N in G.nodes)
-		blocks = self.computeBlocks(groups)
-		self.nodeBlock = dict((N, B) for B in set(P[1] for X in blocks.values() for P in X) for N in B.nodes)
+		groupIDs = dict((G, X) for X, G in enumerate(groups))
+		blocks = self.indexBlocks(groupIDs)
+		self.nodeBlock = dict((N, X[2]) for X in blocks for N in X[2].nodes)
 
 		# Collapse 3 way connected components
-		self.nets = self.computeBasicNets(groups)
-		self.groupNet = dict((G, N) for N in self.nets for G in N.groups)
-		self.nets = self.computeNets(blocks)
-		self.groupNet = dict((G, N) for N in self.nets for G in N.groups)
-		self.chains = self.computeChains(blocks)
-		self.blockChain = dict((B, C) for C in self.chains for B in C)
+		nets = self.computeBasicNets(groups, groupIDs)
+		self.mergeThreeWayComponents(nets, blocks)
+		labels = nets.labels()
+		adjacency = _netAdjacency(labels, blocks)
+		chains = _chainCycles(adjacency)
 
 		# Collapse bridges 
-		self.nets = self._collapseBridges(blocks)
-		self.groupNet = dict((G, N) for N in self.nets for G in N.groups)
-		self.chains = self.computeChains(blocks)
+		if sum(len(X) for X in chains) < len(blocks):
+			self.mergeBridges(nets, labels, adjacency, chains)
+			labels = nets.labels()
+			chains = _chainCycles(_netAdjacency(labels, blocks))
+
+		# Build nets and chains once all merges are known
+		self.nets = [Net(groups[X] for X in component) for component in nets.components()]
+		self.groupNet = dict((G, self.nets[labels[X]]) for X, G in enumerate(groups))
+		self.chains = [Chain(blocks[X][2] for X in chain) for chain in chains]
 		self.blockChain = dict((B, C) for C in self.chains for B in C)
 
 	def copy(self, origin):
@@ -142,26 +190,23 @@ class Cactus(avg.Graph):
 	##########################################
 	## Computing groups
 	##########################################
-	def expandGroup(self, list, node, visited):
-		if node in visited:
-			return list
-		visited[node] = True
-		list.append(node)
-		
-		list = self.expandGroup(list, self[node].partner, visited)
-		return reduce(lambda X,Y: self.expandGroup(X, Y, visited),  self[node].edges.keys(), list)
-
 	def computeGroups(self):
-		groups = []
-		visited = dict()
-		for node in self.nodes():
-			if node not in visited:
-				groups.append(Group(self.expandGroup([], node, visited)))
-		return groups
+		nodes = self.nodes()
+		nodeIDs = dict((N, X) for X, N in enumerate(nodes))
+		sets = UnionFind(len(nodes))
+		for index, node in enumerate(nodes):
+			sets.union(index, nodeIDs[self[node].partner])
+			for dest in self[node].edges:
+				sets.union(index, nodeIDs[dest])
+		return [Group(nodes[X] for X in component) for component in sets.components()]
 
 	##########################################
 	## Computing Blocks
 	##########################################
+	def indexBlocks(self, groupIDs):
+		""" List of (group index, group index, block) triplets """
+		return [(groupIDs[self.nodeGroup[node]], groupIDs[self.nodeGroup[self[node].twin]], Block(node, self[node].twin, self)) for node in self.nodes() if node < self[node].twin]
+
 	def groupPairs3(self, group):
 		return [(group, self.nodeGroup[self[node].twin], Block(node, self[node].twin, self)) for node in group if node < self[node].twin]
 
@@ -177,12 +222,13 @@ class Cactus(avg.Graph):
 	##########################################
 	## Computing Initial nets
 	##########################################
-	def telomericGroups(self):
-		return set(self.nodeGroup[X] for X in self.telomeres)
-
-	def computeBasicNets(self, groups):
-		telomericGroups = self.telomericGroups()
-		return [Net([group]) for group in groups if group not in telomericGroups] + [Net(telomericGroups)]
+	def computeBasicNets(self, groups, groupIDs):
+		""" Union-find over group indices, with all telomeric groups in one set """
+		nets = UnionFind(len(groups))
+		telomericGroups = [groupIDs[self.nodeGroup[X]] for X in self.telomeres]
+		for group in telomericGroups[1:]:
+			nets.union(telomericGroups[0], group)
+		return nets
 
 	##########################################
 	## Computing Net Blocks
@@ -208,77 +254,33 @@ class Cactus(avg.Graph):
 	##########################################
 	## Computing 3 way connected components
 	##########################################
-	def netConnections(self, net, netIDs, netBlocks):
-		return [netIDs[X[0]] for X in netBlocks[net]]
-
-	def connections(self, netIDs, blocks):
-		netBlocks = self.computeNetBlocks(blocks)
-		return map(lambda X: self.netConnections(X, netIDs, netBlocks), self.nets)
-
-	def convertThreeWayResultLine(self, threeWayResultLine, netIDs):
-		return sum((self.nets[X] for X in threeWayResultLine), Net([]))
-
-	def convertThreeWayResults(self, netIDs, threeWayResults):
-		return map(lambda X: self.convertThreeWayResultLine(X, netIDs), threeWayResults)
-
-	def computeNets(self, blocks):
-		netIDs = dict((X[1], X[0]) for X in enumerate(self.nets))
-		threeWayresult = threeWay.components.compute(self.connections(netIDs, blocks))
-		return self.convertThreeWayResults(netIDs, threeWayresult)
-
-	##########################################
-	## Computing chains
-	##########################################
+	def mergeThreeWayComponents(self, nets, blocks):
+		""" Merges the sets of nets which are 3-edge connected through blocks """
+		labels = nets.labels()
+		representatives = _representatives(labels)
+		connections = [[] for X in representatives]
+		for groupA, groupB, block in blocks:
+			connections[labels[groupA]].append(labels[groupB])
+			if groupB != groupA:
+				connections[labels[groupB]].append(labels[groupA])
+
+		for component in threeWay.components.compute(connections):
+			for net in component[1:]:
+				nets.union(representatives[component[0]], representatives[net])
 
-	def computeChains(self, blocks):
-		# Initialization
-		start = self.nets[0]
-		stack = []
-		dfn = dict()
-		father = dict()
-		fatherBlock = dict()
-		chains = []
-		netBlocks = self.computeNetBlocks(blocks)
-
-		# Arbitrary depth first numbering
-		stack = [(start, None, None, 0)]
-		while len(stack) > 0:
-			net, parent, block, depth = stack.pop()
-			if net not in dfn:
-				dfn[net] = depth
-				father[net] = parent
-				fatherBlock[net] = block
-				stack.extend((X[0], net, X[1], depth + 1) for X in netBlocks[net])
-
-		# Look for loop closures
-		for net in self.nets:
-			for net2, block in netBlocks[net]:
-				if block is not fatherBlock[net] and dfn[net2] <= dfn[net]:
-					# Aha: loop closure: follow fathers to self:
-					chain = Chain([block])
-					net3 = net
-					while net3 is not net2:
-						chain.append(fatherBlock[net3])
-						net3 = father[net3]
-					chains.append(chain)
-
-		return chains
-			
 	##########################################
 	## Collapsing bridges
 	##########################################
 
-	def removeChainedBlocks(self, chainedBlocks, blocks, net, netBlocks):
-		blocks[net] = filter(lambda X: X[1] not in chainedBlocks, netBlocks[net])
-		return blocks
-
-	def bridges(self, netBlocks):
-		chainedBlocks = reduce(lambda X, Y: X | set(Y), self.chains, set())
-		return reduce(lambda X,Y: self.removeChainedBlocks(chainedBlocks, X, Y, netBlocks), self.nets, dict())
-
-	def _collapseBridges(self, blocks):
-		bridges = self.bridges(self.computeNetBlocks(blocks))
-		return reduce(lambda X,Y: _collapseBridge(X, Y, bridges), bridges.keys(), self.nets)
+	def mergeBridges(self, nets, labels, adjacency, chains):
+		""" Merges the nets at either end of each path of unchained blocks """
+		chainedBlocks = set(X for chain in chains for X in chain)
+		bridges = [filter(lambda X: X[1] not in chainedBlocks, netBlocks) for netBlocks in adjacency]
+		representatives = _representatives(labels)
+		for net in range(len(bridges)):
+			if len(bridges[net]) != 0 and len(bridges[net]) != 2:
+				for net2, block in bridges[net]:
+					nets.union(representatives[net], representatives[_finalDest(net, net2, bridges)])
 
 	##########################################
 	## Find root net
@@ -30,13 +30,16 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #!/usr/bin/env python
 
-"""Wrapper for the threeWay executable"""
+"""Detection of 3-edge connected components, in process or with the threeWay executable"""
 
 import sys
 import subprocess
 import tempfile
 import os
 
+USE_EXECUTABLE = False
+""" Whether to delegate the computation to the external 3way executable """
+
 ###########################################
 ## Input 
 ###########################################
@@ -73,11 +76,11 @@ def parse3WayOutput(filename):
 	return result
 
 ###########################################
-## Master function
+## External executable
 ###########################################
 
-def compute(connections):
-	"""Wrapper to the threeWay executable, which detects three wat connected components in linear time"""
+def computeExternal(connections):
+	"""Wrapper to the threeWay executable"""
 	file1, input = tempfile.mkstemp(dir='.')
 	file2, output = tempfile.mkstemp(dir='.')
 
@@ -92,6 +95,145 @@ def compute(connections):
 	
 	return parse3WayOutput(output)
 
+###########################################
+## In process 
+###########################################
+
+def adjacencyArrays(connections):
+	"""Flattens adjacency lists into offset and target arrays (CSR)"""
+	offsets = [0]
+	targets = []
+	for connection in connections:
+		targets.extend(connection)
+		offsets.append(len(targets))
+	return offsets, targets
+
+class ThreeEdgeConnectivity(object):
+	"""
+	Tsin's absorb-eject algorithm (Norouzi and Tsin, IPL 2014): a single depth first search 
+	which absorbs 3-edge connected vertices into each other along the current path and ejects
+	finished components when they only hang on to the rest of the graph by 2 edges or fewer.
+	The search is unrolled onto an explicit stack to avoid Python recursion limits.
+	"""
+	def __init__(self, connections):
+		self.offsets, self.targets = adjacencyArrays(connections)
+		n = len(connections)
+		self.visited = [False] * n
+		self.parent = [-1] * n
+		self.parentSkipped = [False] * n
+		self.cursor = self.offsets[:-1]
+		self.pre = [0] * n
+		self.lowpt = [0] * n
+		self.nd = [1] * n
+		self.deg = [0] * n
+		self.pathNext = [-1] * n
+		self.groupNext = [-1] * n
+		self.groupTail = range(n)
+		self.count = 1
+		self.components = []
+
+	def _enter(self, w, parent):
+		self.visited[w] = True
+		self.parent[w] = parent
+		self.pre[w] = self.count
+		self.lowpt[w] = self.count
+		self.count += 1
+
+	def _group(self, w):
+		group = []
+		while w != -1:
+			group.append(w)
+			w = self.groupNext[w]
+		return group
+
+	def _eject(self, w):
+		self.components.append(self._group(w))
+
+	def _absorbPath(self, w, head, target):
+		"""Absorbs into w the vertices of the path starting at head, up to the last ancestor of target (all if target == -1). Returns the rest of the path"""
+		x = head
+		while x != -1 and (target == -1 or self.pre[x] <= self.pre[target] < self.pre[x] + self.nd[x]):
+			self.deg[w] += self.deg[x] - 2
+			self.groupNext[self.groupTail[w]] = x
+			self.groupTail[w] = self.groupTail[x]
+			x = self.pathNext[x]
+		return x
+
+	def _scanEdge(self, w, u, stack):
+		if u == w:
+			# Self loops have no impact on connectivity
+			return
+		self.deg[w] += 1
+		if not self.visited[u]:
+			# Tree edge
+			self._enter(u, w)
+			stack.append(u)
+		elif u == self.parent[w] and not self.parentSkipped[w]:
+			# Tree edge seen from below, further parallel edges are back edges
+			self.parentSkipped[w] = True
+		elif self.pre[u] < self.pre[w]:
+			# Outgoing back edge
+			if self.pre[u] < self.lowpt[w]:
+				self._absorbPath(w, self.pathNext[w], -1)
+				self.pathNext[w] = -1
+				self.lowpt[w] = self.pre[u]
+		else:
+			# Incoming back edge from a descendant
+			self.deg[w] -= 2
+			self.pathNext[w] = self._absorbPath(w, self.pathNext[w], u)
+
+	def _returnFromChild(self, w, u):
+		self.nd[w] += self.nd[u]
+		head = u
+		if self.deg[u] <= 2:
+			if self.deg[u] == 1:
+				# Bridge
+				self.deg[w] -= 1
+			self._eject(u)
+			head = self.pathNext[u]
+		if self.lowpt[w] <= self.lowpt[u]:
+			self._absorbPath(w, head, -1)
+		else:
+			self.lowpt[w] = self.lowpt[u]
+			self._absorbPath(w, self.pathNext[w], -1)
+			self.pathNext[w] = head
+
+	def _search(self, root):
+		self._enter(root, -1)
+		stack = [root]
+		while len(stack) > 0:
+			w = stack[-1]
+			index = self.cursor[w]
+			if index < self.offsets[w + 1]:
+				self.cursor[w] = index + 1
+				self._scanEdge(w, self.targets[index], stack)
+			else:
+				stack.pop()
+				if len(stack) > 0:
+					self._returnFromChild(stack[-1], w)
+		self._eject(root)
+
+	def compute(self):
+		for root in range(len(self.visited)):
+			if not self.visited[root]:
+				self._search(root)
+		return self.components
+
+def computeInProcess(connections):
+	"""Detects three way connected components in linear time"""
+	return ThreeEdgeConnectivity(connections).compute()
+
+###########################################
+## Master function
+###########################################
+
+def compute(connections):
+	"""Detects three way connected components in linear time, connections[i] lists the neighbours of vertex i (once per edge)"""
+	if USE_EXECUTABLE:
+		return computeExternal(connections)
+	else:
+		return computeInProcess(connections)
+
 ###########################################
 ## Unit test
 ###########################################
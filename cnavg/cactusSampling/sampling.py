@@ -37,6 +37,7 @@ import cnavg.avg.graph as avg
 import cnavg.cactus.graph as cactus
 import random
 import math
+import numpy as np
 
 def randomChoice(vector):
 	if len(vector) == 0:
@@ -59,6 +60,15 @@ class NormalizedCactus(cactus.Cactus):
 
 	def __init__(self, cactus):
 		self.copy(cactus)
+		# Pinching updates these structures in place, so detach them from the original cactus
+		self.nets = list(self.nets)
+		self.groupNet = dict(self.groupNet)
+		self.chains = list(self.chains)
+		self.blockChain = dict(self.blockChain)
+		self.netPositions = dict((X, index) for index, X in enumerate(self.nets))
+		self.chainPositions = dict((X, index) for index, X in enumerate(self.chains))
+		self.pinchedNets = set()
+		self.chainCutpoints = dict()
 		self.normalize()
 
 	#########################################
@@ -76,43 +86,81 @@ class NormalizedCactus(cactus.Cactus):
 	##########################################
 	## Test for normalization
 	##########################################
-	def testSegment(self, indexA, indexB, chain):
-		ploidy = chain[indexA].ploidy(self)
-		if not all(chain[X].ploidy(self) == ploidy for X in range(indexA, indexB)):
-			return []
-			
-		chainA = cactus.Chain(chain[indexA:indexB])
-		chainB = cactus.Chain(chain[indexB:] + chain[:indexA])
-		if self.chainIsPloidyDetermined(chain) and not all(self.Test(chainA, chainB, index) for index in range(ploidy)):
-			return []
-
-		length = indexB - indexA
-		weight = math.exp(length)
-		return [(weight, cactus.Chain(chain[indexA:indexB]))]
-
-	def nodeCutpoints2(self, index, chain):
-		return map(lambda X: self.testSegment(X, index, chain), range(index))
-
-	def nodeCutpoints(self, index, chain):
-		return sum(self.nodeCutpoints2(index, chain), [])
+	def ploidyRunEnds(self, chain):
+		""" For each block, index of the first following block of different ploidy """
+		ploidies = [X.ploidy(self) for X in chain]
+		runEnds = [len(chain)] * len(chain)
+		for index in reversed(range(len(chain) - 1)):
+			if ploidies[index + 1] == ploidies[index]:
+				runEnds[index] = runEnds[index + 1]
+			else:
+				runEnds[index] = index + 1
+		return runEnds
 
-	def cutpoints2(self, chain):
-		return map(lambda X: self.nodeCutpoints(X, chain), range(len(chain)))
+	def chainStatistics(self, chain):
+		""" Copy numbers of the blocks of a ploidy determined chain, with prefix sums of lengths and of copynumber x length """
+		ploidy = chain[0].ploidy(self)
+		lengths = np.array([X.length() for X in chain], dtype=float)
+		copynumbers = np.array([[X.copynumber(self, index) for index in range(ploidy)] for X in chain], dtype=float).reshape((len(chain), ploidy))
+		cumulativeLengths = np.concatenate(([0], np.cumsum(lengths)))
+		cumulativeWeights = np.vstack((np.zeros((1, ploidy)), np.cumsum(copynumbers * lengths[:, np.newaxis], axis=0)))
+		return copynumbers, cumulativeLengths, cumulativeWeights
+
+	def separatedSegments(self, statistics, start):
+		""" Mask over the segments [start, end) of a chain, for end in (start, len(chain)), which pass Test in every phase """
+		copynumbers, cumulativeLengths, cumulativeWeights = statistics
+		ends = np.arange(start + 1, len(copynumbers))
+
+		# Segment and complement means, from prefix sums
+		segmentLengths = (cumulativeLengths[ends] - cumulativeLengths[start])[:, np.newaxis]
+		segmentWeights = cumulativeWeights[ends] - cumulativeWeights[start]
+		meanA = segmentWeights / segmentLengths
+		meanB = (cumulativeWeights[-1] - segmentWeights) / (cumulativeLengths[-1] - segmentLengths)
+		separated = np.abs(meanA - meanB) > 0.1 * np.minimum(np.abs(meanA), np.abs(meanB))
+
+		# Every block of the segment must be closer to meanA than to meanB
+		highest = np.maximum.accumulate(copynumbers[start:-1], axis=0)
+		lowest = np.minimum.accumulate(copynumbers[start:-1], axis=0)
+		midpoints = (meanA + meanB) / 2
+		closer = np.where(meanA < meanB, highest < midpoints, lowest > midpoints)
+
+		return np.all(separated & closer, axis=1)
 
 	def cutpoints(self, chain):
-		return sum(self.cutpoints2(chain), [])
+		""" Weighted candidate segments (chain, indexA, indexB), ordered by indexB then indexA """
+		runEnds = self.ploidyRunEnds(chain)
+		if runEnds[0] == len(chain):
+			statistics = self.chainStatistics(chain)
+		else:
+			statistics = None
+		segments = []
+		for indexA in range(len(chain) - 1):
+			indexBs = np.arange(indexA + 1, min(runEnds[indexA], len(chain) - 1) + 1)
+			if statistics is not None:
+				indexBs = indexBs[self.separatedSegments(statistics, indexA)]
+			segments.extend((indexB, indexA) for indexB in indexBs.tolist())
+		segments.sort()
+		return [(math.exp(indexB - indexA), (chain, indexA, indexB)) for indexB, indexA in segments]
 
 	def chainIsUnnormalized(self, chain):
 		if len(chain) > 1:
-			return self.cutpoints(chain)
+			# Chains are only replaced, never modified, so their cutpoints can be kept across pinches
+			if chain not in self.chainCutpoints:
+				self.chainCutpoints[chain] = self.cutpoints(chain)
+			return self.chainCutpoints[chain]
 		else:
 			return []
 
 	def unnormalizedChains(self):
-		return sum(map(self.chainIsUnnormalized, self.chains), [])
+		return [X for chain in self.chains for X in self.chainIsUnnormalized(chain)]
 
 	def unnormalizedChain(self):
-		return randomChoice(self.unnormalizedChains())
+		segment = randomChoice(self.unnormalizedChains())
+		if segment is None:
+			return None
+		else:
+			chain, indexA, indexB = segment
+			return cactus.Chain(chain[indexA:indexB])
 
 	##########################################
 	## Pinching
@@ -130,21 +178,60 @@ class NormalizedCactus(cactus.Cactus):
 			insideNets = set((self.nodeNet(N) for B in chain[1:-1] for N in B.nodes))
 			mergedNets = (startNets | endNets) - insideNets
 
-		return filter(lambda X: X not in mergedNets, self.nets) + [cactus.Net(reduce(lambda X, Y: X | set(Y.groups), mergedNets, set()))]
+		return mergedNets
+
+	def removeFromList(self, items, positions, item):
+		index = positions.pop(item)
+		last = items.pop()
+		if last is not item:
+			items[index] = last
+			positions[last] = index
+
+	def appendToList(self, items, positions, item):
+		positions[item] = len(items)
+		items.append(item)
+
+	def pinchNets(self, mergedNets):
+		# The largest net absorbs the others, so only their groups are remapped
+		if len(mergedNets) < 2:
+			return
+		largest = max(mergedNets, key=lambda X: len(X.groups))
+		others = [X for X in mergedNets if X is not largest]
+		if largest not in self.pinchedNets:
+			# Nets inherited from the original cactus are left untouched
+			others.append(largest)
+			largest = cactus.Net(largest.groups)
+			self.pinchedNets.add(largest)
+			self.appendToList(self.nets, self.netPositions, largest)
+		largest.groups = largest.groups.union(*(X.groups for X in others))
+		for net in others:
+			self.removeFromList(self.nets, self.netPositions, net)
+			self.pinchedNets.discard(net)
+			for group in net.groups:
+				self.groupNet[group] = largest
+
+	def splitChain(self, chain):
+		# The pinched segment and the rest of its chain become separate chains
+		parent = self.blockChain[chain[0]]
+		start = [index for index, X in enumerate(parent) if X is chain[0]][0]
+		end = start + len(chain)
+		assert all(parent[start + index] is X for index, X in enumerate(chain))
+		if len(chain) == len(parent):
+			return
+
+		self.removeFromList(self.chains, self.chainPositions, parent)
+		self.chainCutpoints.pop(parent, None)
+		for newChain in (cactus.Chain(parent[start:end]), cactus.Chain(parent[end:] + parent[:start])):
+			self.appendToList(self.chains, self.chainPositions, newChain)
+			for block in newChain:
+				self.blockChain[block] = newChain
 
 	def pinchChain(self, chain):
 		# Updating the Nets structures
-		self.nets = self.pinchUnnormalizedChain(chain)
-		self.groupNet = dict((G, N) for N in self.nets for G in N.groups)
+		self.pinchNets(self.pinchUnnormalizedChain(chain))
 
 		# Updating the Chains structures
-		groups = [G for N in self.nets for G in N.groups]
-		blocks = self.computeBlocks(groups)
-		self.nodeBlock = dict((N, B) for B in set(P[1] for X in blocks.values() for P in X) for N in B.nodes)
-		self.chains = self.computeChains(blocks)
-		self.blockChain = dict((B, C) for C in self.chains for B in C)
-		assert all(X in self.blockChain for X in self.nodeBlock.values())
-
+		self.splitChain(chain)
 		return self
 
 	##########################################
@@ -32,7 +32,7 @@
 
 """ Merging the SNV and CNV data"""
 
-import vcf
+import cnavg.preprocess.vcfReader as vcfReader
 import random
 import cnavg.history.debug
 
@@ -104,14 +104,16 @@ class SNV(Position):
 def filteredSNV(record):
 	return 'VT' in record.INFO and record.INFO['VT'] == 'SNP' and 'DB' not in record.INFO and record.FILTER is None and 'SS' in record.INFO and record.INFO['SS'] == 'Somatic'
 
-def readVCFRecord(snvs, record):
+def readVCFRecord(record):
 	if filteredSNV(record):
 		call = record.genotype('PRIMARY')
-		snvs.append(SNV(record.CHROM, record.POS, int(call.data['DP'] * call.data['FA']), call.data['DP'], record))
-	return snvs
+		depth = int(call['DP'])
+		return SNV(record.CHROM, record.POS, int(depth * float(call['FA'])), depth, record)
+	else:
+		return None
 
-def readVCFFile(filename):
-	return reduce(readVCFRecord, vcf.Reader(open(filename), prepend_chr=True), [])
+def readVCFFile(filename, processes=1):
+	return vcfReader.parse(filename, readVCFRecord, processes, prependChr=True)
 	
 ########################################
 ## Assigning SNVs to blocks
@@ -34,16 +34,23 @@
 
 import copy
 
+from cnavg.basics.slotted import Slotted
+
 ###############################################
 ## Edge
 ###############################################
-class Edge(object):
+class Edge(Slotted):
+	__slots__ = ('start', 'finish', 'value', 'index')
+
 	def __init__(self, start, finish, value, index=-1):
 		self.start = start
 		self.finish = finish
 		self.value = value
 		self.index = index
 
+	def __copy__(self):
+		return Edge(self.start, self.finish, self.value, self.index)
+
 	def nodes(self):
 		return (self.start, self.finish)
 
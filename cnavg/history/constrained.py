@@ -50,6 +50,7 @@ class ConstrainedHistory(scheduled.ScheduledHistory):
 	def __init__(self, module):
 		super(ConstrainedHistory, self).__init__(module)
 		self.eventCosts = None
+		self.netCosts = dict()
 
         def __copy__(self):
                 new = ConstrainedHistory(self.cactus)
@@ -59,6 +60,7 @@ class ConstrainedHistory(scheduled.ScheduledHistory):
 	def copy(self, other):
 		super(ConstrainedHistory, self).copy(other)
 		self.eventCosts = copy.copy(other.eventCosts)
+		self.netCosts = dict()
                 
         ######################################
         ## Find possible insertion points
@@ -282,7 +284,7 @@ class ConstrainedHistory(scheduled.ScheduledHistory):
 	def computeImbalances(self, cycle, netHistory, duplication, denovo):
 		return reduce(lambda X, Y: self.computeImbalance_Edge(X, Y, netHistory, duplication, denovo), cycle, (set(), 0))[1]
 
-        def rearrangementCost_Net(self, net):
+        def rearrangementCost_Net(self, net, eventCosts):
                 netHistory = self.netHistories[net]
                 originalVector = netHistory.originalVector()
                 bond = netHistory.bondIndices()
@@ -325,8 +327,7 @@ class ConstrainedHistory(scheduled.ScheduledHistory):
 					upper -= 1
 
 				assert lower <= upper, "%i > %i = %i - 1\n%i bonds\n%i created\n%i ancestral\n%s" % (lower, upper, upper + 1, np.sum((eventVector != 0) & bond), np.sum(createdBonds), np.sum((eventVector != 0) & previousBonds), localEvent)
-				self.eventCosts[event][0] += upper
-				self.eventCosts[event][1] += lower
+				eventCosts.append((event, upper, lower))
 				totalLower += lower
 				totalUpper += upper
 
@@ -339,9 +340,46 @@ class ConstrainedHistory(scheduled.ScheduledHistory):
                         queue.extend((X, newVector) for X in self.children[event])
                 return totalUpper, totalLower, totalError
 	
+	def inheritCosts(self, other, nets):
+		""" Reuses the net costs of the history this one was copied from, except on the given nets """
+		if other.error is not None:
+			self.netCosts = dict((X, other.netCosts[X]) for X in other.netCosts if X not in nets)
+
+	def reachableEvents(self):
+		""" Events which are not cut off, with their subtree, by a low ratio """
+		reachable = set()
+		queue = list(self.roots)
+		while len(queue) > 0:
+			event = queue.pop()
+			if debug.DEBUG or event.ratio >= debug.RATIO_CUTOFF:
+				reachable.add(event)
+				queue.extend(self.children[event])
+		return reachable
+
+	def netSignature(self, net, reachable):
+		""" What the cost of a net depends on: its history, its top events, their ancestors within the net and whether they are reachable """
+		netHistory = self.netHistories[net]
+		topEvents = [self.getTopEvent(netHistory, X) for X in netHistory.events]
+		local = set(topEvents)
+		return netHistory, [(X, local.intersection(self.ancestors.get(X, ())), X in reachable) for X in topEvents]
+
+	def netCost(self, net, reachable):
+		""" Cost of a net, recomputed unless the inherited one has the same signature """
+		signature = self.netSignature(net, reachable)
+		if net in self.netCosts and self.netCosts[net][0] == signature:
+			return self.netCosts[net]
+		eventCosts = []
+		return signature, self.rearrangementCost_Net(net, eventCosts), eventCosts
+
 	def computeCost(self):
+		reachable = self.reachableEvents()
+		self.netCosts = dict((X, self.netCost(X, reachable)) for X in self.netHistories)
 		self.eventCosts = dict((X, [0,0]) for X in self.parent)
-		self.upper, self.lower, self.error = sumTrios(map(self.rearrangementCost_Net, self.netHistories))
+		for signature, trio, eventCosts in self.netCosts.values():
+			for event, upper, lower in eventCosts:
+				self.eventCosts[event][0] += upper
+				self.eventCosts[event][1] += lower
+		self.upper, self.lower, self.error = sumTrios(X[1] for X in self.netCosts.values())
 
         def errorCost(self):
                 if self.error is None:
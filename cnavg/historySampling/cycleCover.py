@@ -32,10 +32,15 @@
 
 """Producing an initial flow history underlying a metagenomic net flow change"""
 
+import sys
 import random
 import copy
 import math
-from collections import Counter
+import traceback
+import Queue
+import multiprocessing
+import multiprocessing.pool
+from collections import Counter, OrderedDict, deque
 from cnavg.flows.edge import Edge
 from cnavg.flows.cycle import Cycle
 from cnavg.flows.flows import Event
@@ -87,102 +92,106 @@ def closePseudoTelomeres(module, history):
 		segmentCount = len(module[pseudotelomere].segment)
 		return reduce(closePseudoTelomere, range(segmentCount), (module, history))
 
-#############################################
-## Pre-compute signed node adjacencies
-#############################################
-
-nodeEdgesTable = None
-
-def nodePairAdjacency(node, nodeB, module):
-	# Conjugate flow!
-	return (node, nodeB, -module[node].edges[nodeB], -1)
-
-def nodePairSegment(node, index, module):
-	return (node, module[node].twin, module[node].segment[index], index)
-
-def nodeEdges(node, module):
-	adjacencies = [nodePairAdjacency(node, X, module) for X in module[node].edges]
-	segments = [nodePairSegment(node, X, module) for X in range(len(module[node].segment))]
-	return adjacencies + segments
-
-def computeNodeEdges(module):
-	return dict((X, nodeEdges(X, module)) for X in module.nodes())
-
 #############################################
 ## Search for small edge
 #############################################
 
-def positiveNeighbourhood(node):
-	return filter(lambda X: X[2] > MIN_FLOW, nodeEdgesTable[node])
+def positiveNeighbourhood(node, module):
+	return filter(lambda X: X[2] > MIN_FLOW, module.signedEdges(node))
 
-def negativeNeighbourhood(node):
-	return filter(lambda X: X[2] < -MIN_FLOW, nodeEdgesTable[node])
+def negativeNeighbourhood(node, module):
+	return filter(lambda X: X[2] < -MIN_FLOW, module.signedEdges(node))
 
-def phasedNeighbourhood(node, value):
+def phasedNeighbourhood(node, value, module):
 	if value > 0:
-		return [X[1] for X in positiveNeighbourhood(node)] 
+		return [X[1] for X in positiveNeighbourhood(node, module)] 
 	else:
-		return [X[1] for X in negativeNeighbourhood(node)] 
+		return [X[1] for X in negativeNeighbourhood(node, module)] 
 
-def oppositeNeighbourhood(node, value):
+def oppositeNeighbourhood(node, value, module):
 	if value > 0:
-		return [X[1] for X in negativeNeighbourhood(node)] 
+		return [X[1] for X in negativeNeighbourhood(node, module)] 
 	else:
-		return [X[1] for X in positiveNeighbourhood(node)] 
-
-def adjacencies():
-	return sum(nodeEdgesTable.values(), [])
+		return [X[1] for X in positiveNeighbourhood(node, module)] 
 
 def minimumEdge(module):
-	edges = filter(lambda X: X[0] != X[1] and abs(X[2]) > MIN_FLOW, adjacencies())
-	if len(edges) == 0:
+	res = module.minimumEdge()
+	if res is None:
 		return None
 	else:
-		res = min(edges, key=lambda X: abs(X[2]))
 		return Edge(res[0], res[1], res[2], res[3])
 
 #############################################
 ## Dijkstra
 #############################################
 
-def dijkstra(origin, value, graph, blockTwin):
-    distances = dict(((node, [-1,-1]) for node in graph))
-    todo = [origin] 
-
-    distances[origin][0] = 0
-
-    while len(todo) > 0: 
-	node = todo.pop(0)
-        newdist = distances[node][0] + 1 
-
-	for node2 in oppositeNeighbourhood(node, value):
-	    if blockTwin and node == origin and node2 == graph[origin].twin:
-		continue
-	    if distances[node2][1] > -1:
-		continue
-	    distances[node2][1] = newdist;
-
-	    for node3 in phasedNeighbourhood(node2, value):
-		if distances[node3][0] > -1:
-		    continue
-		else:
-		    distances[node3][0] = newdist
-		    todo.append(node3)
-
-    return distances
+class SearchLayers(object):
+	""" Even and odd BFS distances of the nodes of a module, reused from one search to the next """
+	def __init__(self, module):
+		self.slot = dict((X[1], X[0]) for X in enumerate(module))
+		self.layers = ([-1] * len(self.slot), [-1] * len(self.slot))
+		self.touched = []
+
+	def distance(self, node, phase):
+		return self.layers[phase][self.slot[node]]
+
+	def setDistance(self, node, phase, dist):
+		slot = self.slot[node]
+		self.layers[phase][slot] = dist
+		self.touched.append(slot)
+
+	def reset(self):
+		""" Only clears the slots set since the last reset """
+		for slot in self.touched:
+			self.layers[0][slot] = -1
+			self.layers[1][slot] = -1
+		self.touched = []
+
+def dijkstra(origin, value, graph, blockTwin, distances, target):
+	distances.reset()
+	# The cycle is closed from target through one of these nodes, 
+	# no need to search beyond the layer in which the first is reached
+	closers = set(oppositeNeighbourhood(target, value, graph))
+	todo = deque([origin])
+	distances.setDistance(origin, 0, 0)
+	if origin in closers:
+		closingLayer = 0
+	else:
+		closingLayer = None
+
+	while len(todo) > 0: 
+		node = todo.popleft()
+		dist = distances.distance(node, 0)
+		if closingLayer is not None and dist >= closingLayer:
+			break
+		newdist = dist + 1 
+
+		for node2 in oppositeNeighbourhood(node, value, graph):
+			if blockTwin and node is origin and node2 is graph[origin].twin:
+				continue
+			if distances.distance(node2, 1) > -1:
+				continue
+			distances.setDistance(node2, 1, newdist)
+
+			for node3 in phasedNeighbourhood(node2, value, graph):
+				if distances.distance(node3, 0) > -1:
+					continue
+				distances.setDistance(node3, 0, newdist)
+				todo.append(node3)
+				if closingLayer is None and node3 in closers:
+					closingLayer = newdist
+
+	return distances
 
 #############################################
 ## Heuristic propagation
 #############################################
 
 def signedEdges(node, module, sign):
-	return filter(lambda X: X[2] * sign > MIN_FLOW, nodeEdgesTable[node])
+	return filter(lambda X: X[2] * sign > MIN_FLOW, module.signedEdges(node))
 
 def nodeDistances(node, module, distances, sign, phase):
-	if phase:
-		return map(lambda X: distances[X[1]][1], signedEdges(node, module, sign))
-	else:
-		return map(lambda X: distances[X[1]][0], signedEdges(node, module, sign))
+	return map(lambda X: distances.distance(X[1], phase), signedEdges(node, module, sign))
 
 def minDist(node, module, distances, sign, phase):
 	candidates = filter(lambda X: X >= 0, nodeDistances(node, module, distances, sign, phase))
@@ -195,10 +204,7 @@ def nextNodes(node, module, distances, sign, phase):
 	if dist is None:
 		return None
 	edges = signedEdges(node, module, sign)
-	if phase:
-		return filter(lambda X: distances[X[1]][1] == dist, edges)
-	else:
-		return filter(lambda X: distances[X[1]][0] == dist, edges)
+	return filter(lambda X: distances.distance(X[1], phase) == dist, edges)
 
 def chooseNextNode(node, module, distances, sign, phase):
 	vals = nextNodes(node, module, distances, sign, phase)
@@ -233,8 +239,8 @@ def getAbsEdgeValue(adjacencyIndex, module):
 	else:
 		return abs(module[start].segment[index])
 
-def extractCycle(edge, module):
-	distances = dijkstra(edge.start, edge.value, module, blockTwin=(edge.index >= 0))
+def extractCycle(edge, module, distances):
+	distances = dijkstra(edge.start, edge.value, module, (edge.index >= 0), distances, edge.finish)
 	edgeList, module, success = extendCycle([edge], module, distances, -1)
 	if success:
 		edge_counts = Counter(E.adjacencyIndex() for E in edgeList)
@@ -249,19 +255,19 @@ def extractCycle(edge, module):
 		return None
 
 
-def pickOutCycle(module):
-	global nodeEdgesTable
-	nodeEdgesTable = computeNodeEdges(module)
+def pickOutCycle(module, distances):
 	edge = minimumEdge(module) 
 	if edge is None:
 		# Job finished
 		return None
 	else:
-		return extractCycle(edge, module)
+		return extractCycle(edge, module, distances)
 
 def pickOutCycles(module, history):
+	module.indexEdges(MIN_FLOW)
+	distances = SearchLayers(module)
 	while True:
-		event = pickOutCycle(module)
+		event = pickOutCycle(module, distances)
 		if event is not None:
 			if len(history.events) % 100 == 0:
 				print 'CYCLE', len(history.events)
@@ -290,14 +296,55 @@ def highFlowHistory(history, cactusHistory, net):
 ## Finding an initial net history
 ########################################
 
-def seedHistory(cactusHistory, net, cnvs):
-	M = module.Module(net, cactusHistory.cactus, cnvs)
+def seedCycles(net, cactus, cnvs):
+	""" Extracts a cycle history from the module of a net, without touching the cactus history """
+	M = module.Module(net, cactus, cnvs)
 	H = History(M)
 	MC = copy.copy(M)
 	MC, H1 = closePseudoTelomeres(MC, H)
-	H2 = pickOutCycles(MC, H1)
+	return pickOutCycles(MC, H1)
+
+def seedHistory(cactusHistory, net, cnvs):
+	H2 = cachedSeedCycles(net, cactusHistory.cactus, cnvs)
 	return highFlowHistory(H2, cactusHistory, net)
 
+########################################
+## Memoized net seeding
+########################################
+
+SEED_CACHE_SIZE=128
+""" Number of seeded net histories kept in memory (0 disables the cache) """
+CNV_PRECISION=6
+""" Number of decimals of the chain CNVs which distinguish two seedings of the same net """
+
+# Filled by the initial history of a cactus and reused while sampling it, cleared when the next cactus is seeded
+seedCache = OrderedDict()
+
+def cnvFingerprint(cnvs):
+	return tuple(round(X[0].value, CNV_PRECISION) for X in cnvs)
+
+def rememberSeed(net, cnvs, history):
+	""" Stores a seeded net history, evicting the least recently used ones beyond SEED_CACHE_SIZE """
+	if SEED_CACHE_SIZE <= 0:
+		return
+	seedCache[(net, cnvFingerprint(cnvs))] = history
+	while len(seedCache) > SEED_CACHE_SIZE:
+		seedCache.popitem(last=False)
+
+def cachedSeedCycles(net, cactus, cnvs):
+	""" Same as seedCycles, but returns a copy of a previous seeding when the chain CNVs have not changed """
+	key = (net, cnvFingerprint(cnvs))
+	if key in seedCache:
+		H = seedCache.pop(key)
+	else:
+		H = seedCycles(net, cactus, cnvs)
+	rememberSeed(net, cnvs, H)
+	# The events handed out are absorbed and reweighted by the cactus history
+	return copy.copy(H)
+
+def clearSeedCache():
+	seedCache.clear()
+
 ########################################
 ## Finding an initial cactus graph history
 ########################################
@@ -309,13 +356,114 @@ def propagateInitialHistory_Net(net, history, cnvs):
 	seedHistory(history, net, cnvs)
 	return reduce(lambda X,Y: propagateInitialHistory_Chain(Y, X, history.chainCNVs[Y]), history.cactus.nets2Chains[net], history)
 
+########################################
+## Parallel seeding of independent subtrees
+########################################
+
+# Cactus shared with the workers, set before the pool is forked
+_workerCactus = None
+
+def _cycleTuples(event):
+	return [(X.start.ID, X.finish.ID, X.value, X.index) for X in event.cycle]
+
+def _seedCycles_Process(task):
+	# Nodes do not survive pickling (they hash on identity), so cycles are sent back as node IDs
+	netIndex, cnvValues = task
+	net = _workerCactus.nets[netIndex]
+	# Module only reads the values of the chain CNVs
+	cnvs = [(Edge(None, None, X), None) for X in cnvValues]
+	return map(_cycleTuples, seedCycles(net, _workerCactus, cnvs).events)
+
+def _seedCycles_Thread(task):
+	net, cnvs = task
+	return seedCycles(net, _workerCactus, cnvs)
+
+def _seedCycles_Task(task, threaded):
+	try:
+		if threaded:
+			return True, _seedCycles_Thread(task)
+		else:
+			return True, _seedCycles_Process(task)
+	except Exception:
+		return False, traceback.format_exc()
+
+def _seedCycles_ProcessTask(task):
+	return _seedCycles_Task(task, False)
+
+def _seedCycles_ThreadTask(task):
+	return _seedCycles_Task(task, True)
+
+def _rebuildEvent(tuples, nodes):
+	return Event(Cycle([Edge(nodes[X[0]], nodes[X[1]], X[2], X[3]) for X in tuples], conserve=True))
+
+# Rebuilding a net history costs one Module construction and one absorbEvent per cycle,
+# 1 to 7% of seeding the net, and overlaps with the workers seeding the other pending nets
+def _rebuildHistory(net, cactus, cnvs, cycles):
+	M = module.Module(net, cactus, cnvs)
+	H = History(M)
+	nodes = dict((X.ID, X) for X in M)
+	for tuples in cycles:
+		H.absorbEvent(_rebuildEvent(tuples, nodes))
+	return H
+
+def parallelInitialHistory(cactus, processes, threaded=False):
+	""" Seeds the nets of the cactus on a pool of workers, as soon as the CNVs of their parent chain are known """
+	global _workerCactus
+	_workerCactus = cactus
+	if threaded:
+		pool = multiprocessing.pool.ThreadPool(processes)
+	else:
+		# Forked workers would otherwise all draw the same random sequence
+		pool = multiprocessing.Pool(processes, random.seed)
+	history = constrained.ConstrainedHistory(cactus)
+	netIndices = dict((X[1], X[0]) for X in enumerate(cactus.nets))
+	results = Queue.Queue()
+
+	def submit(net, cnvs):
+		if threaded:
+			pool.apply_async(_seedCycles_ThreadTask, ((net, cnvs),), callback=lambda X: results.put((net, cnvs, X)))
+		else:
+			pool.apply_async(_seedCycles_ProcessTask, ((netIndices[net], [X[0].value for X in cnvs]),), callback=lambda X: results.put((net, cnvs, X)))
+
+	submit(cactus.rootNet, [])
+	pending = 1
+	while pending > 0:
+		net, cnvs, (success, result) = results.get()
+		pending -= 1
+		if not success:
+			pool.terminate()
+			_workerCactus = None
+			sys.exit("Seeding net %s failed:\n%s" % (str(net), result))
+		if threaded:
+			H2 = result
+		else:
+			H2 = _rebuildHistory(net, cactus, cnvs, result)
+		rememberSeed(net, cnvs, H2)
+
+		# Merging is sequential, the children of the net can then be seeded 
+		highFlowHistory(copy.copy(H2), history, net)
+		for chain in cactus.nets2Chains[net]:
+			for child in cactus.chains2Nets[chain]:
+				submit(child, history.chainCNVs[chain])
+				pending += 1
+
+	pool.close()
+	pool.join()
+	_workerCactus = None
+	return history
+
 ###############################################
 ## Master function
 ###############################################
 
-def initialHistory(cactus):
+def initialHistory(cactus, processes=1, threaded=False):
 	print "Extracting initial history from Cactus"
-	return propagateInitialHistory_Net(cactus.rootNet, constrained.ConstrainedHistory(cactus), [])
+	# Seeds of a previous cactus can never be hit again
+	clearSeedCache()
+	if processes > 1:
+		return parallelInitialHistory(cactus, processes, threaded)
+	else:
+		return propagateInitialHistory_Net(cactus.rootNet, constrained.ConstrainedHistory(cactus), [])
 
 ###############################################
 ## Unit test
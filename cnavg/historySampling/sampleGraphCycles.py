@@ -44,6 +44,7 @@ import math
 import copy
 import time
 import cPickle as pickle
+from collections import deque
 
 import cnavg.history.ordered as ordered
 import cnavg.history.flattened as flattened
@@ -79,25 +80,33 @@ def changedCNVs(new, old):
 
 	return any(abs(X[0][0].value - X[1][0].value) > 1e-6 for X in zip(new, old))
 
-def modifyCactusHistory_Net(oldhistory, history, net):
-	for chain in history.cactus.nets2Chains[net]:
-		if changedCNVs(history.chainCNVs[chain], oldhistory.chainCNVs[chain]):
-			modifyCactusHistory_Chain(oldhistory, history, chain)
-	return history
-
-def modifyCactusHistory_Chain(oldhistory, history, chain):
-	for net in history.cactus.chains2Nets[chain]:
-		cycleCover.seedHistory(history, net, history.chainCNVs[chain])
-		modifyCactusHistory_Net(oldhistory, history, net)
-	return history
+def dirtyChains(oldhistory, history, net):
+	return filter(lambda X: changedCNVs(history.chainCNVs[X], oldhistory.chainCNVs[X]), history.cactus.nets2Chains[net])
+
+def propagateCNVChanges(oldhistory, history, net):
+	""" Reseeds, breadth first, the nets hanging under the chains whose CNVs changed, and returns them """
+	reseeded = set()
+	visited = set()
+	todo = deque(dirtyChains(oldhistory, history, net))
+	while len(todo) > 0:
+		chain = todo.popleft()
+		if chain in visited:
+			continue
+		visited.add(chain)
+		for child in history.cactus.chains2Nets[chain]:
+			if child is net or child in reseeded:
+				continue
+			cycleCover.seedHistory(history, child, history.chainCNVs[chain])
+			reseeded.add(child)
+			todo.extend(dirtyChains(oldhistory, history, child))
+	return reseeded
 
 def modifyCactusHistory_Initiate(oldhistory, history, net):
 	newLocalHistory = sampleModuleCycles.createNewHistory(history, history.netHistories[net])
 	history.update(net, newLocalHistory)
 	history.updateCNVs(net, newLocalHistory)
-	for chain in history.cactus.nets2Chains[net]:
-		if changedCNVs(history.chainCNVs[chain], oldhistory.chainCNVs[chain]):
-			modifyCactusHistory_Chain(oldhistory, history, chain)
+	reseeded = propagateCNVChanges(oldhistory, history, net)
+	history.inheritCosts(oldhistory, reseeded | set([net]))
 	return history
 
 ########################################
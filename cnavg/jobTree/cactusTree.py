@@ -281,7 +281,7 @@ class PrepareCBSGraph(Target):
 				items[1] = "chrX"
 			elif items[1] == "24":
 				items[1] = "chrY"
-			else:
+			elif items[1].isdigit():
 				items[1] = "chr" + items[1]
 			out.write("\t".join(map(str, items[1:4] + [items[5]])) + "\n")
 	file.close()
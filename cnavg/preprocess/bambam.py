@@ -35,17 +35,20 @@
 import sys
 import re
 import os
+import itertools
+import multiprocessing
 import numpy
 
-from cnavg.basics.coords import Position
 from breakend import Breakend
-from cnv import CNV
+from cnv import CNV, Coverage
 from breakendGraph import BreakendGraph
-from segmentCNVs import segmentCNVs
+from segmentCNVs import segmentCoverage
 import cbs.cbs
 
 READLENGTH = 50
 BUFFER_LENGTH = 1000
+CHUNK_LINES = 100000
+""" Number of coverage lines parsed together """
 
 #############################################
 ## Chromosomal lengths 
@@ -176,49 +179,68 @@ def parseBreaksFile(file, tabbed):
 	return BreakendGraph(filtered)
 	
 #############################################
-## CNV stuff
+## Coverage files
 #############################################
 
-def parseCNVLine(items, cnvs):
-	if items[1][:3] != "chr":
-		items[1] = "chr" + items[1]
-	cnvs.append(CNV(items[1], items[2], items[3], [float(items[4])], ""))
-	return cnvs
-
-def parseBBLine(cnvs, line):
-	items = line.strip().split()
-	if items[0] == 'CNV':
-		return parseCNVLine(items, cnvs)
+def _chromosomeCode(chr, codes, names):
+	if chr not in codes:
+		if chr[:3] != "chr":
+			name = "chr" + chr
+		else:
+			name = chr
+		if name not in names:
+			names.append(name)
+		codes[chr] = names.index(name)
+	return codes[chr]
+
+def _parseCoverageChunk(lines, column, tag, codes, names):
+	""" Converts a chunk of lines into (chromosome code, start, finish, value) arrays """
+	items = [X.split() for X in lines]
+	if tag is None:
+		items = [X for X in items if len(X) > 0]
 	else:
-		return cnvs
+		items = [X[1:] for X in items if len(X) > 0 and X[0] == tag]
+	return (numpy.array([_chromosomeCode(X[column], codes, names) for X in items], dtype=int),
+		numpy.array([X[column + 1] for X in items]).astype(numpy.int64),
+		numpy.array([X[column + 2] for X in items]).astype(numpy.int64),
+		numpy.array([X[column + 3] for X in items]).astype(float))
+
+def _parseCoverageFile(chunks, file, tag, codes, names):
+	fh = open(file)
+	while True:
+		lines = list(itertools.islice(fh, CHUNK_LINES))
+		if len(lines) == 0:
+			break
+		chunks.append(_parseCoverageChunk(lines, 0, tag, codes, names))
+	fh.close()
+	return chunks
+
+def parseCoverageFiles(files, tag=None):
+	""" Reads coverage files, optionally restricted to the lines starting with tag, into a sorted Coverage """
+	codes = dict()
+	names = []
+	chunks = reduce(lambda C, F: _parseCoverageFile(C, F, tag, codes, names), files, [])
+	if len(chunks) == 0:
+		chunks = [_parseCoverageChunk([], 0, tag, codes, names)]
+	columns = [numpy.concatenate([X[index] for X in chunks]) for index in range(4)]
+	return Coverage(names, *columns)
 
-def parseBBFile(cnvs, file):
-	return reduce(parseBBLine, open(file), cnvs)
+#############################################
+## CNV stuff
+#############################################
 
 def parseCNVData(files):
 	print "\tParsing CNV data"
 	assert len(files) > 1
-	return sorted(reduce(parseBBFile, files, []))
+	return parseCoverageFiles(files, 'CNV')
 
 #############################################
 ## New CNV stuff
 #############################################
 
-def parseNewCNVLine(line):
-	items = line.strip().split()
-	if items[0][:3] != "chr":
-		items[0] = "chr" + items[0]
-	return CNV(items[0], items[1], items[2], [float(items[3])], "")
-
-def parseNewBBFile(file):
-	fh = open(file)
-	res = map(parseNewCNVLine, fh)
-	fh.close()
-	return res
-
 def parseNewCNVData(files):
 	print "\tParsing CNV data"
-	return sorted(sum(map(parseNewBBFile, files), []))
+	return parseCoverageFiles(files)
 
 #############################################
 ## Adding buffers to replace missing colums
@@ -239,106 +261,134 @@ def addMissingCNVs(cnvs):
 ## Phasing stuff
 #############################################
 
-def getAlleleFrequencies_Line(results, line, cnvsByChrom, offsets):
-	items = line.strip().split('\t')
-	if items[0] != 'HAP':
-		return results
+HAPLOTYPE_SEPARATORS = re.compile('[ /:]')
 
-	# Find covering CNV
-	chr = items[1]
-	if len(chr) < 3 or chr[:3] != "chr":
-		chr = "chr" + chr
-	pos = int(items[2])
-	snp = Position(chr, pos)
-	if chr not in offsets:
-		print offsets.keys()
-		print chr
-		assert False
-		return results
-	cnv = cnvsByChrom[chr][offsets[chr]] 
-	while cnv < snp:
-		if offsets[chr] >= len(cnvsByChrom[chr]) - 1:
-			return results
-		cnv = cnvsByChrom[chr][offsets[chr] + 1]
-		if cnv.chr != chr:
-			return results
-		offsets[chr] += 1
-	if cnv > snp:
-		return results
-
-	# Store results
-	germline_haplotype = re.split('[ /:]', items[6])
-	germline_calls = germline_haplotype[0::3]
-	somatic_haplotype = re.split('[ /:]', items[7])
+def _snpCounts(germline, somatic):
+	""" Returns the minority and majority somatic counts of the germline alleles of a HAP line """
+	germline_calls = HAPLOTYPE_SEPARATORS.split(germline)[0::3]
+	somatic_haplotype = HAPLOTYPE_SEPARATORS.split(somatic.strip())
 	somatic_calls = dict(zip(somatic_haplotype[0::3], somatic_haplotype[1::3]))
-	selected = []
-	for call in germline_calls:
-		if call not in somatic_calls:
-			selected.append(0)
-		else:
-			selected.append(int(somatic_calls[call]))
-	results[cnv].append(sorted(selected))
-	return results
-
-def getAlleleFrequencies_File(results, file, cnvsByChrom, offsets):
-	return reduce(lambda r,l: getAlleleFrequencies_Line(r, l, cnvsByChrom, offsets), open(file), results)
-
-def ratioVariance(X, Y):
-	A = numpy.array(X[:(len(X)/2)] + Y[len(X)/2:])
-	B = numpy.array(Y[:(len(X)/2)] + X[len(X)/2:])
-	C = A + B
-	return numpy.var(A[C > 0]/C[C > 0])
-	
-def tTest(X, Y, variance):
-	if len(X) < 2:
-		return False
-	return ratioVariance(X,Y) > 1.5 * variance
-
-def splitPhases(cnv, results, variance):
-	values = results[cnv]
-	majority = map(max, values)
-	minority = map(min, values)
-	if tTest(majority, minority, variance):
-		ratios = [float(X[0])/(X[0] + X[1]) for X in zip(majority, minority) if (X[0] + X[1]) > 0]
-		meanRatio = sum(ratios) / len(ratios)
+	selected = [int(somatic_calls.get(call, 0)) for call in germline_calls]
+	return min(selected), max(selected)
+
+def _readSNPFile(file):
+	""" Returns per-chromosome positions and raw haplotype fields of the HAP lines of a file """
+	snps = dict()
+	fh = open(file)
+	for line in fh:
+		if line[:4] != 'HAP\t':
+			continue
+		items = line.split('\t', 8)
+		chr = items[1]
+		if chr[:3] != "chr":
+			chr = "chr" + chr
+		if chr not in snps:
+			snps[chr] = ([], [])
+		snps[chr][0].append(int(items[2]))
+		snps[chr][1].append((items[6], items[7]))
+	fh.close()
+	return snps
+
+def parseSNPFile(args):
+	""" Joins the SNPs of a file to the first CNV interval which covers them, returns the CNV index, minority and majority counts of each covered SNP """
+	file, bounds, chroms = args
+	columns = ([], [], [])
+	snps = _readSNPFile(file)
+	for chr in sorted(snps):
+		assert chr in chroms, chr
+		if chr not in bounds:
+			continue
+		indices, starts, finishes = bounds[chr]
+		positions = numpy.array(snps[chr][0], dtype=numpy.int64)
+		hits = numpy.searchsorted(finishes, positions)
+		covered = hits < len(finishes)
+		covered[covered] = starts[hits[covered]] <= positions[covered]
+		fields = snps[chr][1]
+		counts = [_snpCounts(*fields[X]) for X in numpy.flatnonzero(covered)]
+		columns[0].append(indices[hits[covered]])
+		columns[1].append(numpy.array([X[0] for X in counts], dtype=numpy.int64))
+		columns[2].append(numpy.array([X[1] for X in counts], dtype=numpy.int64))
+	return columns
+
+def _cnvBounds(cnvs):
+	""" Returns per-chromosome arrays of CNV indices, starts and finishes """
+	cnvIndices = dict()
+	for index, cnv in enumerate(cnvs):
+		cnvIndices.setdefault(cnv.chr, []).append(index)
+	return dict((chr, (numpy.array(cnvIndices[chr]), numpy.array([cnvs[X].start for X in cnvIndices[chr]]), numpy.array([cnvs[X].finish for X in cnvIndices[chr]]))) for chr in cnvIndices)
+
+def assignSNPs(files, cnvs, chroms, processes=1):
+	""" Returns the CNV index, minority and majority counts of all the SNPs covered by a CNV, grouped by CNV """
+	bounds = _cnvBounds(cnvs)
+	jobs = [(file, bounds, set(chroms)) for file in files]
+	if processes > 1 and len(files) > 1:
+		pool = multiprocessing.Pool(processes)
+		try:
+			fileColumns = pool.map(parseSNPFile, jobs)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		fileColumns = map(parseSNPFile, jobs)
+
+	columns = [list(itertools.chain(*(X[column] for X in fileColumns))) for column in range(3)]
+	if len(columns[0]) == 0:
+		return tuple(numpy.zeros(0, dtype=numpy.int64) for X in columns)
+	# Stable sort, so that the SNPs of each CNV stay in file order
+	order = numpy.argsort(numpy.concatenate(columns[0]), kind='mergesort')
+	return tuple(numpy.concatenate(X)[order] for X in columns)
+
+def computeAllelicVariance(minor, major):
+	""" Variance of the allelic ratio, taking the minority allele in half of the SNPs and the majority in the other """
+	total = minor + major
+	valid = total > 0
+	minor, major, total = minor[valid], major[valid], total[valid]
+	half = len(total) / 2
+	shuffled = numpy.concatenate((minor[:half], major[half:])) / total.astype(float)
+	return numpy.var(shuffled)
+
+def allelicStatistics(cnvIndex, minor, major, count):
+	""" Returns the number of SNPs, the variance of the shuffled allelic ratio and the mean majority ratio of each CNV """
+	snps = numpy.bincount(cnvIndex, minlength=count)
+	# Rank of each SNP within its CNV, the first half of each CNV contributes its majority ratio
+	ranks = numpy.arange(len(cnvIndex)) - (numpy.cumsum(snps) - snps)[cnvIndex]
+	total = (minor + major).astype(float)
+	valid = total > 0
+	shuffled = numpy.where(ranks < snps[cnvIndex] / 2, major, minor)[valid] / total[valid]
+	index = cnvIndex[valid]
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		validCount = numpy.bincount(index, minlength=count).astype(float)
+		mean = numpy.bincount(index, weights=shuffled, minlength=count) / validCount
+		variance = numpy.bincount(index, weights=shuffled ** 2, minlength=count) / validCount - mean ** 2
+		majorRatio = numpy.bincount(index, weights=major[valid] / total[valid], minlength=count) / validCount
+	return snps, variance, majorRatio
+
+def splitPhases(cnv, snps, ratioVariance, majorRatio, variance):
+	if snps >= 2 and ratioVariance > 1.5 * variance:
 		value = cnv.val[0]
-		majVal = value * meanRatio
-		minVal = value * (1 - meanRatio)
+		majVal = value * majorRatio
+		minVal = value * (1 - majorRatio)
 		newValues = [majVal, minVal]
 		return CNV(cnv.chr, cnv.start, cnv.finish, newValues, cnv.name, softStart = cnv.softStart, softFinish = cnv.softFinish)
 	else:
 		return cnv
 
-def splitByChroms(cnvsByChrom, cnv):
-	if cnv.chr not in cnvsByChrom:
-		cnvsByChrom[cnv.chr] = []
-	cnvsByChrom[cnv.chr].append(cnv)
-	return cnvsByChrom
-
-def computeAllelicVariance(cnvMarkers):
-	markers = sum(cnvMarkers.values(), [])
-	valid = filter(lambda X: sum(X) > 0, markers)
-	shuffled = [float(X[0])/sum(X) for X in valid[0:int(len(valid)/2)]] + [float(X[1])/sum(X) for X in valid[int(len(valid)/2):len(valid)]]
-	expected = sum(shuffled) / len(shuffled)
-	return sum(X*X for X in shuffled)/len(shuffled) - expected * expected
-
-def phaseCNVs(files, cnvs, chroms):
+def phaseCNVs(files, cnvs, chroms, processes=1):
 	print "Phasing CNVs"
-	offsets = dict((X, 0) for X in chroms)
-	cnvsByChrom = reduce(splitByChroms, cnvs, dict())
 	print '\tReading Heterozygous counts'
-	cnvMarkers = reduce(lambda r,f: getAlleleFrequencies_File(r, f, cnvsByChrom, offsets), files, dict((X,[]) for X in cnvs))
+	cnvIndex, minor, major = assignSNPs(files, cnvs, chroms, processes)
 	print '\tCalculating allelic ratio variance'
-	variance = computeAllelicVariance(cnvMarkers)
+	variance = computeAllelicVariance(minor, major)
 	print 'Variance = ', variance
 	print '\tT-tests across %i blocks' % len(cnvs)
-	return map(lambda X: splitPhases(X, cnvMarkers, variance), cnvs)
+	snps, ratioVariances, majorRatios = allelicStatistics(cnvIndex, minor, major, len(cnvs))
+	return map(lambda X: splitPhases(X[0], X[1], X[2], X[3], variance), zip(cnvs, snps, ratioVariances, majorRatios))
 
 #############################################
 ## Master function
 #############################################
 
-def parse(bbfiles, breaksfile, lengthsfile, tabbed=False, snpsfiles=None):
+def parse(bbfiles, breaksfile, lengthsfile, tabbed=False, snpsfiles=None, processes=1):
 	print "Parsing BamBam data"
 
 	# Reading files
@@ -351,7 +401,7 @@ def parse(bbfiles, breaksfile, lengthsfile, tabbed=False, snpsfiles=None):
 	print "Found %i breakends" % len(breakends) 
 
 	# CNV data
-	cnvs = segmentCNVs(parseNewCNVData(bbfiles))
+	cnvs = segmentCoverage(parseNewCNVData(bbfiles), processes)
 	print "Found %i cnv regions" % len(cnvs) 
 
 	# Quick normalization
@@ -361,7 +411,7 @@ def parse(bbfiles, breaksfile, lengthsfile, tabbed=False, snpsfiles=None):
 
 	# Putting it all together
 	if snpsfiles is not None:
-		cnvs = phaseCNVs(snpsfiles, cnvs, lengths.keys())
+		cnvs = phaseCNVs(snpsfiles, cnvs, lengths.keys(), processes)
 
 	breakends.incorporateCNVs(cnvs)
 	return breakends
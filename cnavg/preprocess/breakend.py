@@ -93,16 +93,16 @@ class Breakend(coords.OrientedRegion):
 			partner.adjacency_cov = [self.adjacency_cov[0]]
 			cutpoint = (max(self.start, self.partner.start) + min(self.finish, self.partner.finish)) / 2
 			if self.orientation:
-				self.start = cutpoint + 1
-				self.partner.finish = cutpoint
+				graph.moveBreakend(self, cutpoint + 1, self.finish)
+				graph.moveBreakend(self.partner, self.partner.start, cutpoint)
 				assert cutpoint + 1 <= self.finish
 				assert cutpoint >= self.partner.start
 			else:
 				assert cutpoint + 1 <= self.partner.finish, "\n".join(map(str, [cutpoint, self, self.partner]))
 				assert cutpoint >= self.start, "\n".join(map(str, [cutpoint, self, self.partner]))
-				self.partner.start = cutpoint + 1
-				self.finish = cutpoint
-			self.partner.start = max(self.partner.start, partner.start)
+				graph.moveBreakend(self.partner, cutpoint + 1, self.partner.finish)
+				graph.moveBreakend(self, self.start, cutpoint)
+			graph.moveBreakend(self.partner, max(self.partner.start, partner.start), self.partner.finish)
 
 			if (not self.orientation and self.start >= self.partner.start) or (self.orientation and self.start < self.partner.start):
 				print self
@@ -131,17 +131,16 @@ class Breakend(coords.OrientedRegion):
 				hits = filter(lambda X: X is not self, hits)
 				assert len(hits) > 0
 			if len(hits) >= 2:
-				hitDistances = sorted((abs(X.position() - self.position()), X) for X in hits)
+				# Ties are broken by list order
+				hitDistances = sorted((abs(X.position() - self.position()), X) for X in graph.inListOrder(hits))
 				hits = [hitDistances[0][1]]
-			assert len(hits) < 2
 			mate = hits[0]
-			self.mates[index] = mate
+			graph.resolveMate(self, index, mate)
 
-			remoteIndex = filter(lambda X: mate.mates[X] is None and mate.remoteChr[X] == self.chr and mate.remoteOrientation[X] == self.orientation and mate.remoteStart[X] < self.finish and mate.remoteFinish[X] > self.start, range(len(mate.mates)))
-			assert len(remoteIndex) < 2
-			if len(remoteIndex) == 1:
-				mate.mates[remoteIndex[0]] = self
-				mate.adjacency_cov[remoteIndex[0]+1] = self.adjacency_cov[index]
+			remoteIndex = graph.pendingMate(mate, self)
+			if remoteIndex is not None:
+				graph.resolveMate(mate, remoteIndex, self)
+				mate.adjacency_cov[remoteIndex+1] = self.adjacency_cov[index]
 			else:
 				mate.mates.append(self)
 				mate.remoteChr.append(self.chr)
@@ -150,7 +149,7 @@ class Breakend(coords.OrientedRegion):
 				mate.remoteOrientation.append(self.orientation)
 				mate.adjacency_cov.append(self.adjacency_cov[index])
 		else:
-			self.mates[index] = mate
+			graph.resolveMate(self, index, mate)
 			mate.mates = [self]
 			mate.remoteChr = [self.chr]
 			mate.remoteStart = [self.start]
@@ -174,26 +173,31 @@ class Breakend(coords.OrientedRegion):
 	## Absorbing another breakend (typically in case of overlaps) 
 	########################################################
 
+	def _mateIndex(self):
+		""" Maps the id of each mate to its first index in the list of mates """
+		return dict((id(mate), index) for index, mate in reversed(list(enumerate(self.mates))))
+
+	def _replaceMate(self, old, new):
+		self.mates[:] = [new if X is old else X for X in self.mates]
+
+	def _mergeMate(self, old, new, coverage):
+		""" Removes the links to old and adds their coverage to the links to new """
+		kept = [(X, C) for X, C in zip(self.mates, self.adjacency_cov[1:]) if X is not old]
+		self.mates[:] = [X for X, C in kept]
+		self.adjacency_cov[1:] = [C + coverage if X is new else C for X, C in kept]
+
 	def _stealMates(self, other):
 		print 'Stealing from %i to %i' % (id(other), id(self))
+		mateIndex = self._mateIndex()
 		for mate, coverage in zip(other.mates, other.adjacency_cov[1:]):
-			if all(X is not mate for X in self.mates):
+			if id(mate) not in mateIndex:
+				mateIndex[id(mate)] = len(self.mates)
 				self.mates.append(mate)
 				self.adjacency_cov.append(coverage)
-				for index in range(len(mate.mates)):
-					if mate.mates[index] is other:
-						mate.mates[index] = self
+				mate._replaceMate(other, self)
 			else:
-				for index in range(len(mate.mates)):
-					if mate.mates[index] is other:
-						mate.mates.pop(index)
-						mate.adjacency_cov.pop(index + 1)
-				for index in range(len(mate.mates)):
-					if mate.mates[index] is self:
-						mate.adjacency_cov[index + 1] += coverage
-				for index in range(len(self.mates)):
-					if self.mates[index] is mate:
-						self.adjacency_cov[index + 1] += coverage
+				mate._mergeMate(other, self, coverage)
+				self.adjacency_cov[mateIndex[id(mate)] + 1] += coverage
 					
 		other.mates = []
 
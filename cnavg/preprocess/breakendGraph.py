@@ -33,27 +33,33 @@
 """Handling a collection of breakends"""
 
 import sys
+import bisect
 import vcf
 import cnavg.avg.graph as avg
 
-def mergeOverlappingBreakends(list, breakend):
-	if any(X is breakend.partner for X in list):
+def mergeOverlappingBreakends(data, breakend):
+	list, kept = data
+	if id(breakend.partner) in kept:
 		list.append(breakend)
+		kept.add(id(breakend))
 	elif breakend.partner < breakend:
 		# Partner was already rejected and absorbed
 		pass
 	elif len(list) == 0 or list[-1] < breakend or list[-1].partner is breakend:
 		list.append(breakend)
-	elif all(X is not breakend.partner for X in list):
+		kept.add(id(breakend))
+	elif id(breakend.partner) not in kept:
 		list[-1].absorb(breakend)
-	elif all(X is not list[-1].partner for X in list):
+	elif id(list[-1].partner) not in kept:
+		kept.discard(id(list[-1]))
 		breakend.absorb(list.pop(-1))  
 		list.append(breakend)
+		kept.add(id(breakend))
 	else:
-		list.remove(breakend.partner)
+		kept.discard(id(list.pop(list.index(breakend.partner))))
 		list[-1].absorb(breakend)
 	
-	return list
+	return data
 
 #########################################################
 ## Graph Structure
@@ -61,24 +67,138 @@ def mergeOverlappingBreakends(list, breakend):
 
 class BreakendGraph(list):
 	""" A collection of breakends organized into a graph """
+	def __init__(self, breakends=()):
+		super(BreakendGraph, self).__init__(breakends)
+		self.index = None
+		self.chromosomeSizes = None
+		self.pendingMates = None
+
 	def validate(self):
 		assert all(map(lambda X: X.validate(), self))
-		assert all(X.partner is None or any(Y is X.partner for Y in self) for X in self)
-		assert all(mate is None or any(Y is mate for Y in self) for X in self for mate in X.mates)
+		members = set(map(id, self))
+		assert all(X.partner is None or id(X.partner) in members for X in self)
+		assert all(mate is None or id(mate) in members for X in self for mate in X.mates)
 
-	def searchBreakend(self, region):
-		""" Search for breakend which covers a given region """ 
-		return filter(lambda X: X == region, self)
+	#########################################################
+	## Interval index
+	#########################################################
 
-	def _smallerNodes(self, region):
-		return filter(lambda X: X < region, self)
+	def _indexBreakend(self, breakend):
+		key = (breakend.chr, breakend.orientation)
+		if key not in self.index:
+			self.index[key] = ([], [], [], [0])
+		starts, breakends, finishes, maxLength = self.index[key]
+		position = bisect.bisect_right(starts, breakend.start)
+		starts.insert(position, breakend.start)
+		breakends.insert(position, breakend)
+		bisect.insort(finishes, breakend.finish)
+		maxLength[0] = max(maxLength[0], breakend.finish - breakend.start)
+		self.chromosomeSizes[breakend.chr] = self.chromosomeSizes.get(breakend.chr, 0) + 1
+
+	def _unindexBreakend(self, breakend):
+		""" Removes a breakend from the interval index, returns False if it was not indexed """
+		key = (breakend.chr, breakend.orientation)
+		if key not in self.index:
+			return False
+		starts, breakends, finishes, maxLength = self.index[key]
+		position = bisect.bisect_left(starts, breakend.start)
+		while position < len(starts) and starts[position] == breakend.start and breakends[position] is not breakend:
+			position += 1
+		if position == len(starts) or breakends[position] is not breakend:
+			return False
+		del starts[position]
+		del breakends[position]
+		del finishes[bisect.bisect_left(finishes, breakend.finish)]
+		self.chromosomeSizes[breakend.chr] -= 1
+		return True
+
+	def _indexPendingMates(self, breakend):
+		for index in range(len(breakend.mates)):
+			if breakend.mates[index] is None:
+				key = (id(breakend), breakend.remoteChr[index], breakend.remoteOrientation[index])
+				self.pendingMates.setdefault(key, []).append(index)
+
+	def indexBreakends(self):
+		""" Builds the index of breakends sorted by start for each chromosome and orientation, and of their unresolved mate slots by remote coordinates.
+		Both are kept up to date by addBreakend, moveBreakend and resolveMate, but not by absorb """
+		self.index = dict()
+		self.chromosomeSizes = dict()
+		self.pendingMates = dict()
+		for breakend in self:
+			self._indexBreakend(breakend)
+			self._indexPendingMates(breakend)
 
-	def _insertionPoint(self, region):
-		return len(self._smallerNodes(region))
+	def searchBreakend(self, region):
+		""" Search for breakend which covers a given oriented region """ 
+		if self.index is None:
+			self.indexBreakends()
+		key = (region.chr, region.orientation)
+		if key not in self.index:
+			return []
+		# Breakends only shrink once indexed, so the longest indexed length bounds the candidates
+		starts, breakends, finishes, maxLength = self.index[key]
+		first = bisect.bisect_left(starts, region.start - maxLength[0])
+		last = bisect.bisect_right(starts, region.finish)
+		return [X for X in breakends[first:last] if X.start <= region.finish and X.finish >= region.start]
+
+	def pendingMate(self, breakend, region):
+		""" Returns the index of the unresolved mate slot of breakend which points into an oriented region, None if there is none """
+		if self.index is None:
+			self.indexBreakends()
+		slots = self.pendingMates.get((id(breakend), region.chr, region.orientation), [])
+		hits = [X for X in slots if breakend.remoteStart[X] < region.finish and breakend.remoteFinish[X] > region.start]
+		assert len(hits) < 2
+		if len(hits) == 1:
+			return hits[0]
+		else:
+			return None
+
+	def resolveMate(self, breakend, index, mate):
+		""" Fills a mate slot of a breakend """
+		if self.index is None:
+			self.indexBreakends()
+		if breakend.mates[index] is None:
+			key = (id(breakend), breakend.remoteChr[index], breakend.remoteOrientation[index])
+			if key in self.pendingMates:
+				self.pendingMates[key].remove(index)
+		breakend.mates[index] = mate
+
+	def inListOrder(self, breakends):
+		""" Returns breakends of the graph in the order of the list """
+		members = set(map(id, breakends))
+		return [X for X in self if id(X) in members]
+
+	def moveBreakend(self, breakend, start, finish):
+		""" Changes the coordinates of a breakend, which may not yet be in the graph """
+		indexed = self.index is not None and self._unindexBreakend(breakend)
+		breakend.start = start
+		breakend.finish = finish
+		if indexed:
+			self._indexBreakend(breakend)
+
+	def _insertionPoint(self, breakend):
+		""" Number of breakends smaller than breakend """
+		# Overlapping breakends compare equal, so the list is not sorted and bisection would not find this point
+		count = sum(self.chromosomeSizes[X] for X in self.chromosomeSizes if X < breakend.chr)
+		for orientation in [False, True]:
+			key = (breakend.chr, orientation)
+			if key not in self.index:
+				continue
+			starts, breakends, finishes, maxLength = self.index[key]
+			# Breakends which finish before breakend starts
+			count += bisect.bisect_left(finishes, breakend.start)
+			if breakend.orientation and not orientation:
+				# Overlapping breakends of the reverse orientation
+				count += bisect.bisect_right(starts, breakend.finish) - bisect.bisect_left(finishes, breakend.start)
+		return count
 
 	def addBreakend(self, breakend):
 		""" Insert breakend """
+		if self.index is None:
+			self.indexBreakends()
 		self.insert(self._insertionPoint(breakend), breakend)
+		self._indexBreakend(breakend)
+		self._indexPendingMates(breakend)
 
 	#########################################################
 	## Consolidating missing labels
@@ -103,7 +223,7 @@ class BreakendGraph(list):
 	#########################################################
 
 	def mergeOverlapping(self):
-		return BreakendGraph(reduce(mergeOverlappingBreakends, sorted(self), []))
+		return BreakendGraph(reduce(mergeOverlappingBreakends, sorted(self), ([], set()))[0])
 
 	#########################################################
 	## Merging CNV info 
@@ -167,11 +287,17 @@ class BreakendGraph(list):
 	## Convert to graph
 	#########################################################
 
-	def _closeChromosome(self, chr, graph, chromosomeLength):
-		chrBreakends = sorted(filter(lambda x: x.chr == chr and x.orientation == False, self), key = lambda X: X.node)
-		if len(chrBreakends) == 0:
-			return
-
+	def _chromosomeBreakends(self):
+		""" Buckets the left-facing breakends by chromosome, each bucket sorted by node """
+		buckets = dict()
+		for breakend in self:
+			if breakend.orientation == False:
+				buckets.setdefault(breakend.chr, []).append(breakend)
+		for chrBreakends in buckets.values():
+			chrBreakends.sort(key = lambda X: X.node)
+		return buckets
+
+	def _closeChromosome(self, chr, graph, chromosomeLength, chrBreakends):
 		telomere1 = graph.createNode(chr, -1, True, name= chr + ".5prime")
 		telomere2 = graph.createNode(chr, chromosomeLength + 1, False, name = chr + ".3prime")
 
@@ -180,16 +306,11 @@ class BreakendGraph(list):
 		graph.createAdjacency(telomere1, telomere2)
 		graph.addLiftedEdge(telomere1, telomere2, -1)
 
-		assert all(sum(x.segment) >= 0 for x in self)
-		assert all(sum(x.segment) >= 0 for x in chrBreakends)
-
-		A = chrBreakends.pop(0)
+		A = chrBreakends[0]
 		graph.createSegment(telomere1, A.node, A.segment)
 		B = A.partner
 
-		while len(chrBreakends) > 0:
-			A = chrBreakends.pop(0)
-			assert sum(A.segment) >= 0
+		for A in chrBreakends[1:]:
 			graph.createSegment(A.node, B.node, A.segment)
 			B = A.partner
 
@@ -202,7 +323,12 @@ class BreakendGraph(list):
 
 		map(lambda X: X.attachNode(graph), self)
 		map(lambda X: X.connectNode(graph), self)
-		map(lambda X: self._closeChromosome(X, graph, self.lengths[X]), self.lengths)
+
+		assert all(sum(x.segment) >= 0 for x in self)
+		buckets = self._chromosomeBreakends()
+		for chr in self.lengths:
+			if chr in buckets:
+				self._closeChromosome(chr, graph, self.lengths[chr], buckets[chr])
 
 		return graph
 
@@ -30,70 +30,369 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #!/usr/bin/env python
 
-"""Wrapper around CBS"""
+"""Circular binary segmentation (CBS) of copy number data"""
 
 import sys
-import subprocess
-import tempfile
+import math
 import os
 import os.path
+import shutil
+import hashlib
+import tempfile
+import multiprocessing
+import numpy as np
 from cnavg.preprocess.cnv import CNV
 
-chromosomeNames = map(lambda X: "chr" + X, map(str, range(1, 23)) + ['X', 'Y'])
-""" The names of the chromosomes, in the order that CBS expects them """
+ALPHA = 0.01
+""" Significance level for accepting a change point """
+NPERM = 10000
+""" Number of permutations used to test a short segment """
+NMIN = 200
+""" Segments with more markers than this are searched block by block and tested with the approximate tail probability instead of permutations """
+PERM_BATCH = 100
+""" Number of permutations evaluated together """
+GRID = 100
+""" Number of points used to integrate the tail probability """
+MIN_WIDTH = 2
+""" Minimum number of markers on either side of a change point """
+UNDO_SD = 3
+""" Change points between segment means closer than this many standard deviations are undone """
+SMOOTH_REGION = 10
+""" Number of neighbours on each side of a marker used to detect outliers """
+OUTLIER_SD_SCALE = 4
+""" Markers this many standard deviations beyond their neighbours are outliers """
+SMOOTH_SD_SCALE = 2
+""" Outliers are brought back to this many standard deviations from their neighbourhood median """
+TRIM = 0.025
+""" Proportion of the marker differences trimmed on each side when estimating the standard deviation """
+SEED = 12345678
+""" Seed of the permutations, so that the segmentation is reproducible """
+CACHE_DIR = 'CBS_CACHE'
+""" Directory where segmentations are stored under the hash of their input and parameters, None disables the cache """
 
 ################################################
-## Conversion functions for input
+## Normal distribution
 ################################################
 
-def _writeCBSLine(index, chrom, pos, val, file):
-	# 'Cause CBS has hard coded chromosome names... 
-	if chrom[:3] == "chr":
-		chrom = chrom[3:]
-	file.write("%i\t%s\t%i\t%f\n" % (index, chrom, pos, val))
+def _normalCDF(x):
+	return 0.5 * (1 + math.erf(x / math.sqrt(2)))
 
-def _writeCBSInput(chrom, pos, vals, output):
-	file = open(output, "w")
-	file.write("SNP\tChromosome\tPhysicalPosition\tsample1\n")
-	for index in range(len(chrom)):
-		_writeCBSLine(index, chrom[index], pos[index], vals[index], file)
-	file.close()
+def _normalQuantile(p):
+	low, high = -10., 10.
+	while high - low > 1e-12:
+		middle = (low + high) / 2
+		if _normalCDF(middle) < p:
+			low = middle
+		else:
+			high = middle
+	return (low + high) / 2
+
+################################################
+## Noise estimation and outlier smoothing
+################################################
+
+def _inflationFactor(trim):
+	# Variance of a standard normal trimmed at both ends
+	a = _normalQuantile(1 - trim)
+	x = np.linspace(-a, a, 10001)
+	x = (x[:-1] + x[1:]) / 2
+	density = np.exp(-x ** 2 / 2) / math.sqrt(2 * math.pi)
+	return 1 / (np.sum(x ** 2 * density / (1 - 2 * trim)) * (2 * a / 10000))
+
+def trimmedSD(values, trim=TRIM):
+	""" Robust estimate of the noise standard deviation from the differences between consecutive markers """
+	differences = np.sort(np.abs(np.diff(values)))
+	kept = int(round((1 - 2 * trim) * (len(values) - 1)))
+	if kept == 0:
+		return 0.
+	return math.sqrt(_inflationFactor(trim) * np.sum(differences[:kept] ** 2) / (2 * kept))
+
+def smoothOutliers(values, sd):
+	""" Pulls markers which stand out from all their neighbours back towards the neighbourhood median """
+	count = len(values)
+	if count < 2:
+		return np.array(values, dtype=float)
+	padded = np.concatenate((np.repeat(np.nan, SMOOTH_REGION), values, np.repeat(np.nan, SMOOTH_REGION)))
+	windows = np.lib.stride_tricks.as_strided(padded, shape=(count, 2 * SMOOTH_REGION + 1), strides=(padded.strides[0], padded.strides[0]))
+	neighbours = np.delete(windows, SMOOTH_REGION, axis=1)
+	highest = np.nanmax(neighbours, axis=1)
+	lowest = np.nanmin(neighbours, axis=1)
+	medians = np.nanmedian(windows, axis=1)
+
+	res = np.array(values, dtype=float)
+	high = res > highest + OUTLIER_SD_SCALE * sd
+	low = res < lowest - OUTLIER_SD_SCALE * sd
+	res[high] = medians[high] + SMOOTH_SD_SCALE * sd
+	res[low] = medians[low] - SMOOTH_SD_SCALE * sd
+	return res
+
+################################################
+## Change point statistics
+################################################
+
+def _lengthWeights(lengths, count):
+	""" Inverse standard deviations of the sums over arcs of the given lengths, zero for arcs that are too short or too long """
+	valid = (lengths >= MIN_WIDTH) & (lengths <= count - MIN_WIDTH)
+	weights = np.zeros(np.shape(lengths))
+	weights[valid] = 1 / np.sqrt(lengths[valid] * (count - lengths[valid]) / float(count))
+	return weights
+
+def _arcWeights(rows, columns, count):
+	""" Weights of the arcs [i, j) for i in rows and j in columns """
+	return _lengthWeights(columns[None, :] - rows[:, None], count)
+
+def _maxArc(sums):
+	""" Returns the largest standardized arc sum with its boundaries, scanning all the arcs """
+	indices = np.arange(len(sums))
+	statistics = np.abs(sums[None, :] - sums[:, None]) * _arcWeights(indices, indices, len(sums) - 1)
+	index = np.argmax(statistics)
+	return statistics.flat[index], index / len(sums), index % len(sums)
+
+def _maxArcCoarse(sums):
+	"""
+	Same as _maxArc, but the arcs are grouped by the blocks of about sqrt(n) markers of their boundaries,
+	and only the pairs of blocks whose upper bound beats the best arc found so far are scanned
+	"""
+	count = len(sums) - 1
+	size = int(math.ceil(math.sqrt(len(sums))))
+	starts = np.arange(0, len(sums), size)
+	ends = np.minimum(starts + size, len(sums))
+	highs = np.maximum.reduceat(sums, starts)
+	lows = np.minimum.reduceat(sums, starts)
+
+	# Arcs [i, j) with i in block A and j in block B
+	A, B = np.triu_indices(len(starts))
+	shortest = np.maximum(starts[B] - ends[A] + 1, MIN_WIDTH)
+	longest = np.minimum(ends[B] - 1 - starts[A], count - MIN_WIDTH)
+	# The weight of an arc is largest at either end of its range of lengths
+	weights = np.maximum(_lengthWeights(shortest, count), _lengthWeights(longest, count))
+	weights[shortest > longest] = 0
+	bounds = np.maximum(highs[B] - lows[A], highs[A] - lows[B]) * weights
+
+	best, start, finish = 0., 0, 0
+	for pair in np.argsort(-bounds, kind='mergesort'):
+		if bounds[pair] <= best:
+			break
+		rows = np.arange(starts[A[pair]], ends[A[pair]])
+		columns = np.arange(starts[B[pair]], ends[B[pair]])
+		statistics = np.abs(sums[None, columns] - sums[rows, None]) * _arcWeights(rows, columns, count)
+		index = np.argmax(statistics)
+		if statistics.flat[index] > best:
+			best = statistics.flat[index]
+			start, finish = rows[index / len(columns)], columns[index % len(columns)]
+	return best, start, finish
+
+def _maxArcs(sums, weights):
+	""" Largest standardized arc sum of each row of sums """
+	return np.max(np.abs(sums[:, None, :] - sums[:, :, None]) * weights[None, :, :], axis=(1, 2))
+
+def _nu(x):
+	# Siegmund's approximation to the overshoot correction of a random walk
+	if x < 1e-10:
+		return 1.
+	return (2 / x) * (_normalCDF(x / 2) - 0.5) / ((x / 2) * _normalCDF(x / 2) + math.exp(-x ** 2 / 8) / math.sqrt(2 * math.pi))
+
+def tailProbability(b, count):
+	""" Approximate probability that the largest standardized arc sum of count white noise markers exceeds b """
+	delta = min(0.5, MIN_WIDTH / float(count))
+	increment = (0.5 - delta) / GRID
+	integral = 0.
+	for point in delta + increment * (np.arange(GRID) + 0.5):
+		spread = point * (1 - point)
+		integral += _nu(b / math.sqrt(count * spread)) ** 2 / spread ** 2
+	# Two-sided test
+	return min(1., b ** 3 * math.exp(-b ** 2 / 2) / math.sqrt(2 * math.pi) / 2 * integral * increment)
+
+def _permutationPValue(values, statistic, random):
+	# Only used on segments of at most NMIN markers, where the full weight matrix is small
+	indices = np.arange(len(values) + 1)
+	weights = _arcWeights(indices, indices, len(values))
+	exceeding = 0
+	for first in range(0, NPERM, PERM_BATCH):
+		batch = min(PERM_BATCH, NPERM - first)
+		permuted = values[np.argsort(random.rand(batch, len(values)), axis=1)]
+		sums = np.hstack((np.zeros((batch, 1)), np.cumsum(permuted, axis=1)))
+		exceeding += np.sum(_maxArcs(sums, weights) >= statistic)
+		# Stop as soon as the segment cannot be significant
+		if exceeding > ALPHA * NPERM:
+			break
+	return exceeding / float(NPERM)
+
+def findChangePoints(values, random):
+	""" Returns the boundaries of the significant arc of a segment, or None """
+	count = len(values)
+	if count < 2 * MIN_WIDTH:
+		return None
+	centered = values - np.mean(values)
+	sums = np.concatenate(([0.], np.cumsum(centered)))
+	if count <= NMIN:
+		statistic, start, finish = _maxArc(sums)
+	else:
+		statistic, start, finish = _maxArcCoarse(sums)
+	if statistic == 0:
+		return None
+
+	if count <= NMIN:
+		pvalue = _permutationPValue(centered, statistic, random)
+	else:
+		residual = np.sum(centered ** 2) - statistic ** 2
+		if residual <= 0:
+			return [start, finish]
+		pvalue = tailProbability(statistic / math.sqrt(residual / (count - 2)), count)
+
+	if pvalue <= ALPHA:
+		return [start, finish]
+	else:
+		return None
 
 ################################################
-## Conversion functions for output
+## Segmentation
 ################################################
-def _parseCBSLine(line, chromosomeNames):
-	items = line.strip().split()
-	cnv = CNV(chromosomeNames[int(items[1]) - 1], items[2], items[3], [float(items[5])], "CNV:" + chromosomeNames[int(items[1]) - 1] + ":" + str((int(items[2]) + int(items[3])) / 2))
-	cnv.numMarks = int(items[4])
+
+def _undoSplits(values, boundaries, sd):
+	""" Removes change points between segments whose means differ by less than UNDO_SD standard deviations """
+	while len(boundaries) > 2:
+		means = np.array([np.mean(values[A:B]) for A, B in zip(boundaries[:-1], boundaries[1:])])
+		differences = np.abs(np.diff(means))
+		index = np.argmin(differences)
+		if differences[index] >= UNDO_SD * sd:
+			break
+		boundaries.pop(index + 1)
+	return boundaries
+
+def segmentValues(values, sd, random):
+	""" Recursively splits the markers of a chromosome, returns the list of segment boundaries """
+	boundaries = set([0, len(values)])
+	segments = [(0, len(values))]
+	while len(segments) > 0:
+		start, finish = segments.pop()
+		changePoints = findChangePoints(values[start:finish], random)
+		if changePoints is None:
+			continue
+		cuts = sorted(set([start] + [start + X for X in changePoints] + [finish]))
+		boundaries.update(cuts)
+		segments.extend(zip(cuts[:-1], cuts[1:]))
+	return _undoSplits(values, sorted(boundaries), sd)
+
+def segmentChromosome(arguments):
+	""" Segments the markers of one chromosome, returns (first, last, marker count, mean) tuples """
+	positions, values, sd = arguments
+	random = np.random.RandomState(SEED)
+	smoothed = smoothOutliers(values, sd)
+	# Splits are undone against the noise of the smoothed chromosome, as DNAcopy does
+	boundaries = segmentValues(smoothed, trimmedSD(smoothed), random)
+	return [(positions[A], positions[B - 1], B - A, np.mean(smoothed[A:B])) for A, B in zip(boundaries[:-1], boundaries[1:])]
+
+def _chromosomeMarkers(chrom, pos, vals):
+	""" Groups the markers by chromosome, in order of first appearance """
+	order = []
+	markers = dict()
+	for chr, position, value in zip(chrom, pos, vals):
+		if chr not in markers:
+			order.append(chr)
+			markers[chr] = ([], [])
+		markers[chr][0].append(position)
+		markers[chr][1].append(value)
+	return [(chr, markers[chr][0], np.array(markers[chr][1], dtype=float)) for chr in order]
+
+def _segmentCNV(chr, segment):
+	start, finish, numMarks, mean = segment
+	cnv = CNV(chr, start, finish, [float(mean)], "CNV:" + chr + ":" + str((int(start) + int(finish)) / 2))
+	cnv.numMarks = numMarks
 	return cnv
 
-def _parseCBSFile(input, chromosomeNames):
+################################################
+## Output file
+################################################
+
+def _parseCBSLine(line):
+	items = line.strip().split('\t')
+	return _segmentCNV(items[1], (int(items[2]), int(items[3]), int(items[4]), float(items[5])))
+
+def _parseCBSFile(input):
 	regions = []
 	file2 = open(input)	
 	file2.readline()
 	for line in file2:
-		regions.append(_parseCBSLine(line, chromosomeNames))	
+		regions.append(_parseCBSLine(line))	
 	file2.close()
 	return regions
 
+def _writeCBSFile(cnvs, output):
+	file = open(output, "w")
+	file.write("ID\tchrom\tloc.start\tloc.end\tnum.mark\tseg.mean\n")
+	for cnv in cnvs:
+		file.write("sample1\t%s\t%i\t%i\t%i\t%.17g\n" % (cnv.chr, cnv.start, cnv.finish, cnv.numMarks, cnv.val[0]))
+	file.close()
+
+################################################
+## Segmentation cache
+################################################
+
+def _parameters():
+	return (ALPHA, NPERM, NMIN, PERM_BATCH, GRID, MIN_WIDTH, UNDO_SD, SMOOTH_REGION, OUTLIER_SD_SCALE, SMOOTH_SD_SCALE, TRIM, SEED)
+
+def segmentationKey(chrom, pos, vals):
+	""" Hash of the input vectors and of the segmentation parameters """
+	digest = hashlib.sha1()
+	digest.update(repr(_parameters()))
+	digest.update("\0".join(map(str, chrom)))
+	digest.update(np.asarray(pos, dtype=np.int64).tostring())
+	digest.update(np.asarray(vals, dtype=np.float64).tostring())
+	return digest.hexdigest()
+
+def _storeSegmentation(cnvs, output):
+	""" Writes a cache entry under a temporary name first, so that a partial file is never read back """
+	try:
+		os.makedirs(CACHE_DIR)
+	except OSError:
+		if not os.path.isdir(CACHE_DIR):
+			raise
+	file, temporary = tempfile.mkstemp(dir=CACHE_DIR)
+	os.close(file)
+	_writeCBSFile(cnvs, temporary)
+	os.rename(temporary, output)
+
 ################################################
 ## Master function 
 ################################################
-def run(chrom, pos, vals):
+
+def segment(chrom, pos, vals, processes=1):
+	""" Segments three vectors of data: chromosome, position, value """
+	chromosomes = _chromosomeMarkers(chrom, pos, vals)
+	sd = trimmedSD(np.array(vals, dtype=float))
+	tasks = [(positions, values, sd) for chr, positions, values in chromosomes]
+	if processes > 1 and len(tasks) > 1:
+		pool = multiprocessing.Pool(processes)
+		try:
+			results = pool.map(segmentChromosome, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		results = map(segmentChromosome, tasks)
+
+	return [_segmentCNV(chromosome[0], segment) for chromosome, segments in zip(chromosomes, results) for segment in segments]
+
+def run(chrom, pos, vals, processes=1):
 	""" Run CBS on three vectors of data: chromosome, position, value"""
-	if not os.path.exists('CBS_OUT'):
-		print 'Running CBS...'
-		file1, input = tempfile.mkstemp(dir='.')
-		os.close(file1)
-
-		_writeCBSInput(chrom, pos, vals, input)
-		if subprocess.Popen(['cbs.R', input, 'CBS_OUT'], stdout=sys.stdout, stderr=subprocess.STDOUT).wait() != 0:
-		    sys.exit("CBS did not complete")
-		os.remove(input)
-	
-	print 'Reading CBS output...'
-	return _parseCBSFile('CBS_OUT', chromosomeNames)
+	if CACHE_DIR is None:
+		cached = None
+	else:
+		cached = os.path.join(CACHE_DIR, segmentationKey(chrom, pos, vals))
+
+	if cached is not None and os.path.exists(cached):
+		print 'Reading cached CBS output...'
+		cnvs = _parseCBSFile(cached)
+		shutil.copyfile(cached, 'CBS_OUT')
+		return cnvs
+
+	print 'Running CBS...'
+	cnvs = segment(chrom, pos, vals, processes)
+	_writeCBSFile(cnvs, 'CBS_OUT')
+	if cached is not None:
+		_storeSegmentation(cnvs, cached)
+	return cnvs
 
 ################################################
 ## Unit test
@@ -33,6 +33,7 @@
 """CNV data holder"""
 
 import sys
+import numpy as np
 import cnavg.basics.coords as coords
 from breakend import Breakend
 
@@ -88,3 +89,39 @@ class CNV(coords.Region):
 
 	def ploidy(self):
 		return len(self.val)
+
+################################################
+## Coverage bins
+################################################
+
+class Coverage(object):
+	""" Raw coverage bins stored as columns, sorted by chromosome then position like CNVs """
+	def __init__(self, names, codes, starts, finishes, values):
+		# Chromosome codes are renumbered by name order so that a single lexsort orders the bins
+		order = np.argsort(names)
+		ranks = np.empty(len(names), dtype=int)
+		ranks[order] = np.arange(len(names))
+		codes = ranks[np.asarray(codes, dtype=int)]
+		bins = np.lexsort((finishes, starts, codes))
+		self.names = [names[X] for X in order]
+		self.codes = codes[bins]
+		self.starts = np.asarray(starts, dtype=np.int64)[bins]
+		self.finishes = np.asarray(finishes, dtype=np.int64)[bins]
+		self.values = np.asarray(values, dtype=float)[bins]
+
+	def __len__(self):
+		return len(self.codes)
+
+	def chromosomes(self):
+		""" Returns the chromosome name of each bin """
+		return [self.names[X] for X in self.codes]
+
+	def medians(self):
+		""" Returns the central position of each bin """
+		return (self.starts + self.finishes) / 2
+
+def coverageFromCNVs(cnvs):
+	""" Converts a list of single-valued CNVs into columns """
+	names = sorted(set(X.chr for X in cnvs))
+	codes = dict((X, index) for index, X in enumerate(names))
+	return Coverage(names, [codes[X.chr] for X in cnvs], [X.start for X in cnvs], [X.finish for X in cnvs], [X.val[0] for X in cnvs])
@@ -34,7 +34,7 @@
 
 import sys
 import cbs.cbs as cbs
-from cnv import CNV
+from cnv import CNV, coverageFromCNVs
 
 def _mergeCNVs_Forward(A, B):
 	for i in range(A.ploidy()):
@@ -87,57 +87,69 @@ def _filterCNVs(cnvs):
 			filtered += [cnv]
 	return filtered
 
-def _glueCNV(cnvs, index):
-	prev = cnvs[index-1]
-	cnv = cnvs[index]
-	if prev.chr == cnv.chr and prev.finish < cnv.start and prev.finish > cnv.start - 50:
-		prev.finish = cnv.start
+def _glueCoverage(coverage):
+	""" Extends each bin up to the next one when they are less than 50bp apart """
+	sameChr = coverage.codes[:-1] == coverage.codes[1:]
+	finishes = coverage.finishes[:-1]
+	starts = coverage.starts[1:]
+	glued = sameChr & (finishes < starts) & (finishes > starts - 50)
+	finishes[glued] = starts[glued]
 
-def _glueCNVs(cnvs):
-	map(lambda X: _glueCNV(cnvs, X), range(1, len(cnvs))) 
-
-def _computeBorderMargins(segments, sortedCNVs):
+def _computeBorderMargins(segments, coverage):
 	print "Computing CNV border margins"
+	# Plain lists, the walk below visits every bin once
+	chrs = coverage.chromosomes()
+	starts = coverage.starts.tolist()
+	finishes = coverage.finishes.tolist()
+
+	def before(index, segment):
+		# Same as CNV comparison: bin < segment
+		return chrs[index] < segment.chr or (chrs[index] == segment.chr and starts[index] <= segment.finish and finishes[index] < segment.start)
+
+	def overlaps(index, segment):
+		# Same as CNV comparison: bin == segment
+		return chrs[index] == segment.chr and starts[index] <= segment.finish and finishes[index] >= segment.start
+
 	cnvindex = 0
 	for segment in segments:
-		while len(sortedCNVs) > 0 and sortedCNVs[cnvindex] < segment:
+		while len(chrs) > 0 and before(cnvindex, segment):
 			cnvindex += 1
-			assert cnvindex < len(sortedCNVs)
+			assert cnvindex < len(chrs)
 		
-		if cnvindex > 0 and sortedCNVs[cnvindex - 1].chr == segment.chr:
-			segment.start = sortedCNVs[cnvindex - 1].start
+		if cnvindex > 0 and chrs[cnvindex - 1] == segment.chr:
+			segment.start = starts[cnvindex - 1]
 		else:
-			segment.start = sortedCNVs[cnvindex].start
-		segment.softStart = sortedCNVs[cnvindex].finish
+			segment.start = starts[cnvindex]
+		segment.softStart = finishes[cnvindex]
 
-		while cnvindex < len(sortedCNVs) and sortedCNVs[cnvindex] == segment:
+		while cnvindex < len(chrs) and overlaps(cnvindex, segment):
 			cnvindex += 1
 	
 		# Backing up to last valid index
 		assert cnvindex > 0
 		cnvindex -= 1
-		segment.softFinish = sortedCNVs[cnvindex].start
+		segment.softFinish = starts[cnvindex]
 		if segment.softFinish == segment.start:
-			segment.softStart = sortedCNVs[cnvindex].start + 1
-			segment.softFinish = sortedCNVs[cnvindex].finish - 1
+			segment.softStart = starts[cnvindex] + 1
+			segment.softFinish = finishes[cnvindex] - 1
 		if segment.softFinish <= segment.softStart:
 			segment.softFinish = segment.softStart + 1
-		if cnvindex < len(sortedCNVs) - 1 and sortedCNVs[cnvindex + 1].chr == segment.chr:
-			segment.finish = sortedCNVs[cnvindex + 1].finish
+		if cnvindex < len(chrs) - 1 and chrs[cnvindex + 1] == segment.chr:
+			segment.finish = finishes[cnvindex + 1]
 		else:
-			segment.finish = sortedCNVs[cnvindex].finish
+			segment.finish = finishes[cnvindex]
 		assert segment.finish > segment.start
 		if segment.softFinish >= segment.finish:
 			print cnvindex
-			print len(sortedCNVs) - 1
-			print sortedCNVs[cnvindex + 1].chr
+			print len(chrs) - 1
+			print chrs[cnvindex + 1]
 			print segment.chr
-			print sortedCNVs[cnvindex].start
+			print starts[cnvindex]
 			print segment.softStart
 			print segment.softFinish
-			if cnvindex < len(sortedCNVs) - 1:
-				print sortedCNVs[cnvindex + 1].finish
-			print sortedCNVs[cnvindex].finish
+			if cnvindex < len(chrs) - 1:
+				print finishes[cnvindex + 1]
+			print finishes[cnvindex]
 		segment.validate()
 
 	return segments
@@ -146,23 +158,19 @@ def _computeBorderMargins(segments, sortedCNVs):
 ## Master function
 ###########################################
 
-def _median(X):
-	return (X.start + X.finish)/2
-
-def segmentCNVs(cnvs):
+def segmentCoverage(coverage, processes=1):
+	""" Segments sorted coverage bins, only the segments are turned into CNV objects """
 	print "Segmentation of CNV data"
-	sortedCNVs = sorted(cnvs)	
-	_glueCNVs(sortedCNVs)
-
-	chrom = [X.chr for X in sortedCNVs]
-	pos = map(_median, sortedCNVs)
-	vals = [X.val[0] for X in sortedCNVs]
+	_glueCoverage(coverage)
 
-	cbsCNVS = cbs.run(chrom, pos, vals)
+	cbsCNVS = cbs.run(coverage.chromosomes(), coverage.medians(), coverage.values, processes)
 	sortedCBSCNVs = sorted(cbsCNVS)
 	filtered = _filterCNVs(sortedCBSCNVs)
 
-	return _computeBorderMargins(filtered, sortedCNVs)
+	return _computeBorderMargins(filtered, coverage)
+
+def segmentCNVs(cnvs, processes=1):
+	return segmentCoverage(coverageFromCNVs(cnvs), processes)
 	
 ###########################################
 ## Unit test
@@ -34,10 +34,14 @@
 
 import sys
 import re
-import vcf
 
 import cnavg.avg.graph as avg
 import breakendGraph
+import vcfReader
+from breakend import Breakend
+
+TUMOR_SAMPLE = 'PRIMARY'
+""" Name of the sample whose read depths are assigned to the breakends """
 
 ###############################################
 ## Parsing the chromosome lengths
@@ -55,19 +59,20 @@ def _parseChromLengths(file):
 ## Parsing the VCF file
 ###############################################
 
-def _parseVCFBreakend(breakends, record):
-	if record.FILTER != 'PASS':
-		return breakends
+def _parseVCFBreakend(record):
+	if record.FILTER is not None:
+		return None
 
-	if "SVTYPE" not in record.INFO or record.INFO["SVTYPE"] != "BND":
-		return breakends
+	if record.INFO.get("SVTYPE") != "BND":
+		return None
 
-	assert len(record.ALT) > 0
-	assert all(X.reconnects for X in record.ALT)
-	breakend = breakendGraph.Breakend(record.CHROM, record.POS, record.ALT[0].orientation, record.ID)
-	breakend.remoteChr = [X.chr for X in record.ALT]
-	breakend.remotePos = [X.pos for X in record.ALT]
-	breakend.remoteOrientation = [X.remoteOrientation for X in record.ALT]
+	remotes = map(vcfReader.parseBreakend, record.ALT)
+	assert len(remotes) > 0
+	assert all(X is not None for X in remotes)
+	breakend = Breakend(record.CHROM, record.POS, remotes[0][2], record.ID)
+	breakend.remoteChr = [X[0] for X in remotes]
+	breakend.remotePos = [X[1] for X in remotes]
+	breakend.remoteOrientation = [X[3] for X in remotes]
 	breakend.adjacency_cov = [ 0 for x in breakend.remoteChr]
 	breakend.adjacency_cov.append(0)
 
@@ -78,17 +83,16 @@ def _parseVCFBreakend(breakends, record):
 
 	assert len(record.samples) > 1
 
-	depths = sampleData[format['BDP']]
-	for allele in genotypes:
-		breakend.adjacency_cov[genotypes[allele]] += float(depths[allele])
+	# Read depths are listed per allele, the reference allele first
+	call = record.genotype(TUMOR_SAMPLE)
+	for allele, depth in enumerate(call['BDP'].split(',')):
+		breakend.adjacency_cov[allele] += float(depth)
 
-	breakend.segment_cov = int(sampleData[format['DP']])
-	
-	breakends[breakend.ID] = breakend
-	return breakends
+	breakend.segment_cov = int(call['DP'])
+	return breakend
 
-def _parseVCFFile(vcffile):
-	return reduce(_parseVCFBreakend, vcf.Reader(open(vcffile)), dict())
+def _parseVCFFile(vcffile, processes=1):
+	return dict((X.ID, X) for X in vcfReader.parse(vcffile, _parseVCFBreakend, processes))
 
 ########################################################
 ## Replace name by pointers
@@ -108,9 +112,9 @@ def _AlignPointers(breakends):
 ## Master function
 ########################################################
 
-def parse(vcffile, lengthsFile):
+def parse(vcffile, lengthsFile, processes=1):
 	"""Produce breakend graph from VCF file"""
-	breakends = _parseVCFFile(vcffile)
+	breakends = _parseVCFFile(vcffile, processes)
 	_AlignPointers(breakends)
 	graph = breakendGraph.BreakendGraph(sorted(breakends.values()))
 	graph.consolidate()
@@ -0,0 +1,290 @@
+# Copyright (c) 2012, Daniel Zerbino
+# All rights reserved.
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# (1) Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer. 
+# 
+# (2) Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in
+# the documentation and/or other materials provided with the
+# distribution.  
+# 
+# (3)The name of the author may not be used to
+# endorse or promote products derived from this software without
+# specific prior written permission.
+# 
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#!/usr/bin/env python
+
+"""Streaming VCF reader, restricted to the fields used by the breakend and SNV parsers"""
+
+import re
+import struct
+import zlib
+import gzip
+import itertools
+import multiprocessing
+
+from cnavg.basics.slotted import Slotted
+
+CHUNK_BYTES = 1 << 20
+""" Size of the chunks into which plain text VCF files are cut before being distributed between processes """
+
+INFO_LISTS = set(['MATEID'])
+""" INFO keys whose values are comma separated lists """
+
+BREAKEND_BRACKETS = re.compile('[\[\]]')
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+GZIP_MAGIC = '\x1f\x8b'
+
+###############################################
+## Records
+###############################################
+
+class VCFRecord(Slotted):
+	"""Light weight VCF record, with the attribute names of the pyvcf Record class.
+	INFO, FORMAT and samples are only parsed when accessed, most records being discarded on FILTER or ALT"""
+	__slots__ = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'FILTER', 'sampleNames', '_items', '_info']
+
+	def __init__(self, line, sampleNames, prependChr=False):
+		items = line.rstrip('\r\n').split('\t')
+		self.CHROM = items[0]
+		if prependChr and self.CHROM[:3] != 'chr':
+			self.CHROM = 'chr' + self.CHROM
+		self.POS = int(items[1])
+		self.ID = items[2] if items[2] != '.' else None
+		self.REF = items[3]
+		self.ALT = items[4].split(',')
+		# As in pyvcf, passing and unfiltered records both have a null filter
+		if items[6] == 'PASS' or items[6] == '.':
+			self.FILTER = None
+		else:
+			self.FILTER = items[6].split(';')
+		self.sampleNames = sampleNames
+		self._items = items
+		self._info = None
+
+	@property
+	def INFO(self):
+		if self._info is None:
+			self._info = _parseInfo(self._items[7])
+		return self._info
+
+	@property
+	def FORMAT(self):
+		if len(self._items) > 8:
+			return self._items[8].split(':')
+		else:
+			return []
+
+	@property
+	def samples(self):
+		return self._items[9:]
+
+	def genotype(self, name):
+		""" Returns the dictionary of FORMAT values (as strings) of a sample """
+		return dict(zip(self.FORMAT, self._items[9 + self.sampleNames.index(name)].split(':')))
+
+def _parseInfo(field):
+	info = dict()
+	if field == '.':
+		return info
+	for item in field.split(';'):
+		pair = item.split('=', 1)
+		if len(pair) == 1:
+			info[pair[0]] = True
+		elif pair[0] in INFO_LISTS:
+			info[pair[0]] = pair[1].split(',')
+		else:
+			info[pair[0]] = pair[1]
+	return info
+
+def parseBreakend(alt):
+	""" Returns the remote chromosome, position, orientation and remote orientation of an ALT in breakend notation, None otherwise """
+	if '[' not in alt and ']' not in alt:
+		return None
+	items = BREAKEND_BRACKETS.split(alt)
+	chr, pos = items[1].rsplit(':', 1)
+	if chr[0] == '<':
+		chr = chr[1:-1]
+	return chr, int(pos), alt[0] in '[]', '[' in alt
+
+###############################################
+## Chunked input
+###############################################
+
+def _isGzipped(file):
+	fh = open(file, 'rb')
+	magic = fh.read(2)
+	fh.close()
+	return magic == GZIP_MAGIC
+
+def _bgzfBlockSize(fh):
+	""" Reads the header of the BGZF block at the current offset, returns the total block size, None at the end of the file, or if the file is not BGZF """
+	header = fh.read(12)
+	if len(header) < 12 or header[:4] != BGZF_MAGIC:
+		return None
+	extra = fh.read(struct.unpack('<H', header[10:12])[0])
+	offset = 0
+	while offset + 4 <= len(extra):
+		length = struct.unpack('<H', extra[offset + 2:offset + 4])[0]
+		if extra[offset:offset + 2] == 'BC':
+			return struct.unpack('<H', extra[offset + 4:offset + 6])[0] + 1
+		offset += 4 + length
+	return None
+
+def _bgzfBlockOffsets(file):
+	""" Returns the offsets of all the blocks of a BGZF file, None if the file is not BGZF """
+	offsets = []
+	fh = open(file, 'rb')
+	while True:
+		offset = fh.tell()
+		size = _bgzfBlockSize(fh)
+		if size is None:
+			break
+		offsets.append(offset)
+		fh.seek(offset + size)
+	trailing = fh.read(1)
+	fh.close()
+	if len(trailing) > 0 or len(offsets) == 0:
+		return None
+	return offsets
+
+def _bgzfChunks(file, offset):
+	""" Iterates through the decompressed blocks of a BGZF file, starting at a block offset """
+	fh = open(file, 'rb')
+	fh.seek(offset)
+	while True:
+		size = _bgzfBlockSize(fh)
+		if size is None:
+			break
+		block = fh.read(size - fh.tell() + offset)
+		offset += size
+		# Skip the CRC32 and ISIZE trailer
+		yield zlib.decompress(block[:-8], -15)
+	fh.close()
+
+def _plainChunks(file, offset):
+	""" Iterates through fixed size chunks of a plain text file, starting at a byte offset """
+	fh = open(file, 'rb')
+	fh.seek(offset)
+	while True:
+		data = fh.read(CHUNK_BYTES)
+		if len(data) == 0:
+			break
+		yield data
+	fh.close()
+
+def _rangeLines(chunks, first, count):
+	""" Iterates through the lines owned by a range of count chunks.
+	A line belongs to the chunk which contains the newline preceding it, the first line of the file to the first chunk """
+	if first:
+		pending = ''
+	else:
+		pending = None
+	for index, data in enumerate(chunks):
+		if index >= count:
+			# Finish the line started within the range, if any
+			if pending is None:
+				return
+			end = data.find('\n')
+			if end < 0:
+				pending += data
+				continue
+			yield pending + data[:end]
+			return
+		if pending is None:
+			start = data.find('\n')
+			if start < 0:
+				continue
+			data = data[start + 1:]
+			pending = ''
+		lines = (pending + data).split('\n')
+		pending = lines.pop()
+		for line in lines:
+			yield line
+	if pending:
+		yield pending
+
+def _ranges(file, processes):
+	""" Cuts a file into contiguous ranges of chunks, returns a list of (chunk iterator function, offset, is first range, chunk count) """
+	if _isGzipped(file):
+		offsets = _bgzfBlockOffsets(file)
+		if offsets is None:
+			# Non blocked gzip files cannot be split
+			return [(None, 0, True, None)]
+		reader = _bgzfChunks
+	else:
+		fh = open(file, 'rb')
+		fh.seek(0, 2)
+		offsets = range(0, max(fh.tell(), 1), CHUNK_BYTES)
+		fh.close()
+		reader = _plainChunks
+
+	step = -(-len(offsets) // processes)
+	return [(reader, offsets[X], X == 0, step) for X in range(0, len(offsets), step)]
+
+###############################################
+## Parsing
+###############################################
+
+def readHeader(file):
+	""" Returns the sample names of a VCF file """
+	if _isGzipped(file):
+		fh = gzip.open(file)
+	else:
+		fh = open(file)
+	for line in fh:
+		if line[:6] == '#CHROM':
+			fh.close()
+			return line.rstrip('\r\n').split('\t')[9:]
+		if line[0] != '#':
+			break
+	fh.close()
+	return []
+
+def _parseRange(args):
+	file, reader, offset, first, count, sampleNames, function, prependChr = args
+	if reader is None:
+		lines = gzip.open(file)
+	else:
+		lines = _rangeLines(reader(file, offset), first, count)
+	results = []
+	for line in lines:
+		if len(line) == 0 or line[0] == '#':
+			continue
+		result = function(VCFRecord(line, sampleNames, prependChr))
+		if result is not None:
+			results.append(result)
+	return results
+
+def parse(file, function, processes=1, prependChr=False):
+	""" Applies a function to every record of a plain or bgzipped VCF file, returns the list of results which are not None, in file order.
+	With processes > 1 the file is cut into byte ranges which are parsed concurrently, the function must then be picklable """
+	sampleNames = readHeader(file)
+	tasks = [(file, reader, offset, first, count, sampleNames, function, prependChr) for reader, offset, first, count in _ranges(file, processes)]
+	if processes > 1 and len(tasks) > 1:
+		pool = multiprocessing.Pool(processes)
+		try:
+			results = pool.map(_parseRange, tasks)
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		results = map(_parseRange, tasks)
+	return list(itertools.chain(*results))
@@ -39,6 +39,7 @@ import cnavg.preprocess.vcf as vcf
 import cnavg.preprocess.bambam as bambam
 
 import cnavg.avg.balanced as balancedAVG
+import cnavg.avg.gabp.gabp as gabp
 import cnavg.cactus.graph as cactus
 import cnavg.cactusSampling.sampling as normalized
 import cnavg.cactus.oriented as oriented
@@ -68,6 +69,9 @@ def _parseOptions():
 	parser.add_argument('--tabbed', dest='tabbed', action='store_true', help='Tabbed BamBam breakend file')
 	parser.add_argument('--size', '-s', dest='size', type=int, default=100, help='Number of sampled histories')
 	parser.add_argument('--temp', '-t', dest='temp', type=float, default=1, help='Starting temperature of MCMC sampling')
+	parser.add_argument('--processes', dest='processes', type=int, default=1, help='Number of workers used to parse the input, segment the CNVs, balance the graph and seed the initial history')
+	parser.add_argument('--threaded', dest='threaded', action='store_true', help='Seed the initial history with threads instead of processes')
+	parser.add_argument('--gabp', dest='gabp', action='store_true', help='Balance the graph with Gaussian belief propagation instead of a direct solver')
 	return parser.parse_args()
 
 def _parseGraph(options):
@@ -76,9 +80,9 @@ def _parseGraph(options):
 	if options.bambam is not None and options.breaks is not None and options.chromLengths is not None:
 		options.bambam = sum(map(glob.glob, options.bambam), [])
 		assert len(options.bambam) > 0, options.bambam
-		breakends = bambam.parse(options.bambam, options.breaks, options.chromLengths, snpsfiles=options.snpsfiles, tabbed=options.tabbed)
+		breakends = bambam.parse(options.bambam, options.breaks, options.chromLengths, snpsfiles=options.snpsfiles, tabbed=options.tabbed, processes=options.processes)
 	elif options.vcffile is not None and options.chromLengths is not None:
-		breakends = vcf.parse(options.vcffile, options.chromLengths)
+		breakends = vcf.parse(options.vcffile, options.chromLengths, processes=options.processes)
 	else:
 		if options.vcffile is None:
 			print "No VCF"
@@ -118,10 +122,13 @@ def main():
 	if options.simulation:
 		debug.RATIO_TO_OFFSET = False
 
+	if options.gabp:
+		balancedAVG.SOLVER = gabp.solve
+
 	if options.index is None:
 		## Initial graph construction
 		G = _parseGraph(options)
-		B = balancedAVG.BalancedAVG(G)
+		B = balancedAVG.BalancedAVG(G, options.processes)
 		C = cactus.Cactus(B)
 		pickle.dump(C, open('CACTUS', "wb"))
 	else:
@@ -163,7 +170,7 @@ def main():
 		if options.integer:
 			debug.INTEGER_HISTORY = True
 		if H is None:
-			H = cycleCover.initialHistory(OC)
+			H = cycleCover.initialHistory(OC, options.processes, options.threaded)
 		FH = flattened.flattenGraph(H)
 		S = FH.simplifyStubsAndTrivials()
 		F = S.removeLowRatioEvents(debug.RATIO_CUTOFF)